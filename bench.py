@@ -2,22 +2,35 @@
 A much shorter version of train.py for benchmarking
 """
 import os
+import resource
 from contextlib import nullcontext
 import numpy as np
 import time
 import torch
 from model import GPTConfig, GPT
+from dataloader import BatchLoader, random_offsets, gather_windows
+from module_profiler import ModuleProfiler
 
 # -----------------------------------------------------------------------------
 batch_size = 12
 block_size = 1024
 bias = False
+loss_chunk_size = 0 # > 0: chunked cross-entropy, compare the peak memory against 0
+recompute = 'none' # activation recomputation policy: 'none', 'all', 'every_n' or 'attn'
+recompute_every_n = 2
 real_data = True
+sort_offsets = False # read the windows of a batch in file order
+bench_data = False # microbenchmark data loading alone (tokens/sec) instead of training
 seed = 1337
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
 dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
 compile = True # use PyTorch 2.0 to compile the model to be faster
 profile = False # use pytorch profiler, or just simple benchmarking?
+module_profile = False # time and activation memory per GPT module from forward/backward hooks, ranked table + JSON
+module_profile_steps = 10 # number of steps to average the module profile over, after a few warmup steps
+module_profile_json = 'module_profile.json'
+bench_generate = False # benchmark generation tokens/sec vs output length instead of training
+rolling_stride = 256 # rolling window stride of the KV cache used in the generation benchmark
 exec(open('configurator.py').read()) # overrides from command line or config file
 # -----------------------------------------------------------------------------
 
@@ -34,12 +47,9 @@ if real_data:
     dataset = 'openwebtext'
     data_dir = os.path.join('data', dataset)
     train_data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
+    loader = BatchLoader(os.path.join(data_dir, 'train.bin'), batch_size, block_size, device, seed=seed, sort_offsets=sort_offsets)
     def get_batch(split):
-        data = train_data # note ignore split in benchmarking script
-        ix = torch.randint(len(data) - block_size, (batch_size,))
-        x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
-        y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
-        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
+        x, y, _ = loader.next_batch() # note ignore split in benchmarking script
         return x, y
 else:
     # alternatively, if fixed data is desired to not care about data loading
@@ -53,17 +63,86 @@ gptconf = GPTConfig(
     n_layer = 12, n_head = 12, n_embd = 768, # size of the model
     dropout = 0, # for determinism
     bias = bias,
+    loss_chunk_size = loss_chunk_size,
+    recompute = recompute, recompute_every_n = recompute_every_n,
 )
 model = GPT(gptconf)
 model.to(device)
 
 optimizer = model.configure_optimizers(weight_decay=1e-2, learning_rate=1e-4, betas=(0.9, 0.95), device_type=device_type)
 
-if compile:
+if compile and not (bench_generate or bench_data or module_profile):
     print("Compiling model...")
     model = torch.compile(model) # pytorch 2.0
 
-if profile:
+if bench_data:
+    # tokens/sec of data loading alone: the old per-row slicing (2*B slice-and-widen copies, y rereading
+    # almost the same bytes as x) vs a single vectorized gather of B windows of block_size+1 tokens
+    assert real_data, "the data loading microbenchmark needs real_data=True"
+    data = train_data
+    g = torch.Generator().manual_seed(seed)
+    buf = torch.empty((batch_size, block_size + 1), dtype=torch.int64)
+    def per_row():
+        ix = torch.randint(len(data) - block_size, (batch_size,), generator=g)
+        x = torch.stack([torch.from_numpy((data[i:i+block_size]).astype(np.int64)) for i in ix])
+        y = torch.stack([torch.from_numpy((data[i+1:i+1+block_size]).astype(np.int64)) for i in ix])
+    def gathered(sort):
+        ix = random_offsets(len(data), batch_size, block_size, g, sort=sort)
+        gather_windows(data, ix.numpy(), block_size, buf)
+    num_batches = 200
+    for name, fn in [('per-row slices', per_row),
+                     ('vectorized gather', lambda: gathered(False)),
+                     ('vectorized gather, sorted offsets', lambda: gathered(True))]:
+        fn() # warmup
+        t0 = time.time()
+        for _ in range(num_batches):
+            fn()
+        dt = time.time() - t0
+        print(f"{name:>34s}: {num_batches * batch_size * block_size / dt:,.0f} tokens/sec, {dt / num_batches * 1000:.3f}ms per batch")
+
+elif bench_generate:
+    # tokens/sec vs output length, for a full recompute of the context per token, the KV cache
+    # (which has to re-encode the whole window every token once past block_size) and the rolling window
+    model.eval()
+    prompt = torch.randint(gptconf.vocab_size, (1, 16), device=device)
+    modes = [
+        ('recompute', dict(use_kv_cache=False)),
+        ('kv cache', dict()),
+        (f'rolling stride {rolling_stride}', dict(rolling_stride=rolling_stride)),
+    ]
+    for max_new_tokens in [block_size // 2, block_size, 2 * block_size, 4 * block_size]:
+        for name, kwargs in modes:
+            t0 = time.time()
+            with ctx:
+                model.generate(prompt, max_new_tokens, top_k=200, **kwargs)
+            if device_type == 'cuda':
+                torch.cuda.synchronize()
+            dt = time.time() - t0
+            print(f"{max_new_tokens:6d} new tokens, {name:>20s}: {max_new_tokens / dt:8.2f} tokens/sec")
+
+elif module_profile:
+    # where a GPTConfig spends its time, module by module, without reading a trace
+    profiler = None
+    X, Y = get_batch('train')
+    for k in range(3 + module_profile_steps):
+        if k == 3:
+            profiler = ModuleProfiler(model, cuda=(device_type == 'cuda')) # after 3 warmup steps without hooks
+        t0 = profiler.now() if profiler else 0.0
+        with ctx:
+            logits, loss = model(X, Y)
+        t1 = profiler.now() if profiler else 0.0
+        X, Y = get_batch('train')
+        optimizer.zero_grad(set_to_none=True)
+        t2 = profiler.start_backward() if profiler else 0.0
+        loss.backward()
+        if profiler:
+            profiler.step((t1 - t0) * 1000, (profiler.now() - t2) * 1000)
+        optimizer.step()
+        print(f"{k}/{3 + module_profile_steps} loss: {loss.item():.4f}")
+    profiler.remove()
+    profiler.print_table(module_profile_json)
+
+elif profile:
     # useful docs on pytorch profiler:
     # - tutorial https://pytorch.org/tutorials/intermediate/tensorboard_profiler_tutorial.html
     # - api https://pytorch.org/docs/stable/profiler.html#torch.profiler.profile
@@ -96,8 +175,11 @@ if profile:
 else:
 
     # simple benchmarking
-    torch.cuda.synchronize()
+    if device_type == 'cuda':
+        torch.cuda.synchronize()
     for stage, num_steps in enumerate([10, 20]): # burnin, then benchmark
+        if device_type == 'cuda':
+            torch.cuda.reset_peak_memory_stats()
         t0 = time.time()
         X, Y = get_batch('train')
         for k in range(num_steps):
@@ -109,9 +191,22 @@ else:
             optimizer.step()
             lossf = loss.item()
             print(f"{k}/{num_steps} loss: {lossf:.4f}")
-        torch.cuda.synchronize()
+        if device_type == 'cuda':
+            torch.cuda.synchronize()
         t1 = time.time()
         dt = t1-t0
         mfu = model.estimate_mfu(batch_size * 1 * num_steps, dt)
         if stage == 1:
-            print(f"time per iteration: {dt/num_steps*1000:.4f}ms, MFU: {mfu*100:.2f}%")
+            print(f"time per iteration: {dt/num_steps*1000:.4f}ms, MFU: {mfu*100:.2f}%, recompute: {recompute}")
+            if device_type == 'cpu':
+                print(f"peak RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/2**20:.2f}GiB")
+            if device_type == 'cuda':
+                # what stays allocated between steps (params, grads are freed, optimizer state) vs the peak within
+                # a step, which is dominated by activations and scales with batch_size
+                static_mem = torch.cuda.memory_allocated()
+                peak_mem = torch.cuda.max_memory_allocated()
+                per_sample = (peak_mem - static_mem) / batch_size
+                total_mem = torch.cuda.get_device_properties(device).total_memory
+                print(f"peak memory: {peak_mem/2**30:.2f}GiB, static {static_mem/2**30:.2f}GiB, "
+                      f"{per_sample/2**20:.1f}MiB per sample (loss_chunk_size={loss_chunk_size}), "
+                      f"max batch_size ~{int((total_mem - static_mem) / per_sample)}")
@@ -0,0 +1,168 @@
+"""
+Non-blocking checkpoint writer for train.py.
+
+save() takes a quick snapshot of the checkpoint dict in CPU memory and hands the slow
+torch.save to a background thread, so the training loop (and with it every other DDP rank,
+which would otherwise idle at the next all-reduce) only waits for the device-to-host copy.
+Only one write is in flight at a time: save() blocks while the previous one is still running.
+Files are written to a temporary name and renamed into place, so a crash mid-write never
+leaves a truncated ckpt.pt behind.
+
+load_checkpoint() is the matching read side for DDP runs: rank 0 reads the file (mmap'd, so
+tensors are only paged in as they are sent) and broadcasts it, instead of every rank reading
+the whole checkpoint from the (network) drive at the same time.
+"""
+import os
+import re
+import time
+import threading
+
+import torch
+import torch.distributed as dist
+
+def _tensor_key(t):
+    # identifies views of the same memory, e.g. the tied wte / lm_head weights
+    return (t.data_ptr(), t.dtype, tuple(t.shape), t.stride(), t.device)
+
+def snapshot_to_cpu(obj, memo=None):
+    """ a copy of obj with every tensor copied to CPU, keeping tensors that share storage (tied weights) shared """
+    memo = {} if memo is None else memo
+    if torch.is_tensor(obj):
+        key = _tensor_key(obj)
+        if key not in memo:
+            # always a copy, even on CPU: the training loop keeps updating the originals in place
+            memo[key] = obj.detach().to('cpu', copy=True)
+        return memo[key]
+    if isinstance(obj, dict):
+        return {k: snapshot_to_cpu(v, memo) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot_to_cpu(v, memo) for v in obj)
+    return obj
+
+def atomic_save(obj, path):
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+class _TensorRef:
+    """ stands in for a tensor in the (pickled) skeleton of a broadcast checkpoint """
+    def __init__(self, index):
+        self.index = index
+
+def _split_tensors(obj, tensors, memo):
+    # replace every tensor of obj by a _TensorRef into tensors, shared tensors are only sent once
+    if torch.is_tensor(obj):
+        key = _tensor_key(obj)
+        if key not in memo:
+            memo[key] = _TensorRef(len(tensors))
+            tensors.append(obj)
+        return memo[key]
+    if isinstance(obj, dict):
+        return {k: _split_tensors(v, tensors, memo) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_split_tensors(v, tensors, memo) for v in obj)
+    return obj
+
+def _merge_tensors(obj, tensors):
+    if isinstance(obj, _TensorRef):
+        return tensors[obj.index]
+    if isinstance(obj, dict):
+        return {k: _merge_tensors(v, tensors) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_merge_tensors(v, tensors) for v in obj)
+    return obj
+
+def broadcast_checkpoint(checkpoint, device, src=0):
+    """ send the checkpoint dict of rank src to all ranks, returns it on every rank with its tensors on device """
+    tensors = []
+    if dist.get_rank() == src:
+        skeleton = _split_tensors(checkpoint, tensors, {})
+        metas = [(tuple(t.shape), t.dtype) for t in tensors]
+    else:
+        skeleton, metas = None, None
+    objects = [skeleton, metas]
+    dist.broadcast_object_list(objects, src=src) # everything but the tensors, a small pickle
+    skeleton, metas = objects
+    received = []
+    for i, (shape, dtype) in enumerate(metas):
+        if dist.get_rank() == src:
+            t = tensors[i].to(device).contiguous()
+        else:
+            t = torch.empty(shape, dtype=dtype, device=device)
+        dist.broadcast(t, src=src)
+        received.append(t)
+    return _merge_tensors(skeleton, received)
+
+def load_checkpoint(path, device, broadcast=False):
+    """
+    torch.load the checkpoint at path onto device. With broadcast=True (in a torch.distributed run)
+    only rank 0 reads the file and sends it to the other ranks.
+    """
+    if not broadcast:
+        return torch.load(path, map_location=device)
+    checkpoint = None
+    if dist.get_rank() == 0:
+        checkpoint = torch.load(path, map_location='cpu', mmap=True)
+    return broadcast_checkpoint(checkpoint, device)
+
+class AsyncCheckpointer:
+
+    def __init__(self, out_dir, keep_iters=(), keep_last=0, async_write=True, suffix=''):
+        self.out_dir = out_dir
+        # appended to the file names, e.g. '_optim3' for rank 3's shard of a sharded optimizer: ckpt_optim3.pt
+        self.suffix = suffix
+        # retention of the ckpt_{iter}.pt snapshots: the ones in keep_iters are kept forever,
+        # of all others only the keep_last most recent (0 = keep all of them)
+        self.keep_iters = set(keep_iters)
+        self.keep_last = keep_last
+        self.async_write = async_write
+        self.thread = None
+        self.error = None
+
+    def save(self, checkpoint, filenames):
+        """ write checkpoint to each of filenames in out_dir, returns the seconds the caller was blocked """
+        t0 = time.time()
+        self.wait() # only block if the previous write is still running
+        snapshot = snapshot_to_cpu(checkpoint)
+        if self.async_write:
+            self.thread = threading.Thread(target=self._write, args=(snapshot, filenames))
+            self.thread.start()
+        else:
+            self._write(snapshot, filenames)
+            self.wait() # surface any error right away
+        return time.time() - t0
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise RuntimeError("writing a checkpoint failed") from error
+
+    def filename(self, filename):
+        root, ext = os.path.splitext(filename)
+        return root + self.suffix + ext
+
+    def _write(self, snapshot, filenames):
+        try:
+            os.makedirs(self.out_dir, exist_ok=True)
+            for filename in filenames:
+                filename = self.filename(filename)
+                t0 = time.time()
+                atomic_save(snapshot, os.path.join(self.out_dir, filename))
+                print(f"wrote {filename} to {self.out_dir} in {time.time()-t0:.2f}s")
+            self._prune()
+        except Exception as e:
+            self.error = e
+
+    def _prune(self):
+        if self.keep_last <= 0:
+            return
+        snapshots = []
+        for f in os.listdir(self.out_dir):
+            m = re.fullmatch(rf'ckpt_(\d+){re.escape(self.suffix)}\.pt', f)
+            if m and int(m.group(1)) not in self.keep_iters:
+                snapshots.append((int(m.group(1)), f))
+        for _, f in sorted(snapshots)[:-self.keep_last]:
+            os.remove(os.path.join(self.out_dir, f))
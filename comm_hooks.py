@@ -0,0 +1,109 @@
+"""
+DDP communication hooks that compress the gradient all-reduce, for runs where it is bandwidth
+bound (e.g. multi-node over Ethernet, NCCL_IB_DISABLE=1). Selected in train.py with ddp_comm_hook:
+- 'none': DDP's own fp32 all-reduce
+- 'fp16' / 'bf16': gradients are cast to 16 bits for the all-reduce, halving the bytes sent
+- 'powersgd': rank-powersgd_rank PowerSGD compression with error feedback (https://arxiv.org/abs/1905.13727),
+  after powersgd_start_iter plain all-reduce steps
+'fp16' and 'powersgd' also work on a gloo (CPU) cluster, 'bf16' only if the gloo build can all-reduce
+bfloat16, use 'fp16' otherwise. Next to the hook, a CommCounter is returned that tracks the payload
+bytes handed to the all-reduce, so the runs can be compared per step.
+
+Compression trades bytes for gradient accuracy, so a compressed run should also be checked for loss
+parity. With train.py's loss_log, a run with ddp_comm_hook='none' writes its losses to loss.jsonl;
+a compressed run of the same config and seed given that file as loss_reference reports, via LossLog,
+how far its train and val loss are from the reference run's at the same iterations.
+"""
+import json
+from collections import defaultdict, deque
+
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks, powerSGD_hook
+
+class CommCounter:
+    """ payload bytes all-reduced since the last pop() """
+
+    def __init__(self, static_bytes=None):
+        # without a hook we can't observe the buckets, but the payload is just all the gradients every step
+        self.static_bytes = static_bytes
+        self.bytes = 0
+
+    def pop(self):
+        if self.static_bytes is not None:
+            return self.static_bytes
+        nbytes, self.bytes = self.bytes, 0
+        return nbytes
+
+def _powersgd_bytes(state, bucket):
+    # mirrors the decisions of powerSGD_hook: plain all-reduce during the first start_powerSGD_iter steps,
+    # afterwards the P (n, r) and Q (m, r) factors of every matrix worth compressing, the rest as is
+    element_size = bucket.buffer().element_size()
+    if state.iter < state.start_powerSGD_iter:
+        return bucket.buffer().numel() * element_size
+    numel = 0
+    for grad in bucket.gradients():
+        n, m = grad.shape[0], grad.numel() // grad.shape[0]
+        r = min(n, m, state.matrix_approximation_rank)
+        if (n + m) * r * state.min_compression_rate < n * m:
+            numel += (n + m) * r
+        else:
+            numel += n * m
+    return numel * element_size
+
+def register_comm_hook(model, name, powersgd_rank=1, powersgd_start_iter=1000):
+    """ register the communication hook name on the DDP model, returns a CommCounter of its bytes """
+    if name == 'none':
+        return CommCounter(sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad))
+    counter = CommCounter()
+    if name in ('fp16', 'bf16'):
+        hook = default_hooks.fp16_compress_hook if name == 'fp16' else default_hooks.bf16_compress_hook
+        state = None # the default process group
+        count = lambda state, bucket: bucket.buffer().numel() * 2
+    elif name == 'powersgd':
+        hook = powerSGD_hook.powerSGD_hook
+        state = powerSGD_hook.PowerSGDState(process_group=None, matrix_approximation_rank=powersgd_rank,
+                                            start_powerSGD_iter=powersgd_start_iter)
+        count = _powersgd_bytes
+    else:
+        raise ValueError(f"unknown ddp_comm_hook {name}, expected 'none', 'fp16', 'bf16' or 'powersgd'")
+
+    def counting_hook(state, bucket):
+        counter.bytes += count(state, bucket) # before the hook, which advances the PowerSGD iteration
+        return hook(state, bucket)
+
+    model.register_comm_hook(state, counting_hook)
+    return counter
+
+class LossLog:
+    """ losses of this run, appended to a JSONL file and compared against a reference run's file """
+
+    def __init__(self, path=None, reference_path='', window=10):
+        self.file = open(path, 'a', buffering=1) if path else None
+        self.reference = defaultdict(dict) # 'loss' / 'val_loss' -> iter -> loss of the reference run
+        if reference_path:
+            with open(reference_path) as f:
+                for line in f:
+                    record = json.loads(line)
+                    for key, value in record.items():
+                        if key != 'iter':
+                            self.reference[key][record['iter']] = value
+        # (loss, reference loss) at the last window iterations logged by both runs, per key
+        self.recent = defaultdict(lambda: deque(maxlen=window))
+
+    def log(self, iter_num, **losses):
+        if self.file is not None:
+            self.file.write(json.dumps({'iter': iter_num, **losses}) + "\n")
+        for key, value in losses.items():
+            if iter_num in self.reference[key]:
+                self.recent[key].append((value, self.reference[key][iter_num]))
+
+    def gap(self, key):
+        """ relative difference of the mean loss vs the reference over the recent shared iterations, None without any """
+        recent = self.recent[key]
+        if not recent:
+            return None
+        return sum(l for l, _ in recent) / sum(r for _, r in recent) - 1
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,11 @@
+# overlay for multi-node runs whose gradient all-reduce goes over Ethernet, compresses it with PowerSGD.
+# add it after the main config, and check loss parity against a run without it, which writes out/loss.jsonl:
+# $ torchrun --nproc_per_node=8 --nnodes=2 ... train.py config/train_gpt2.py --loss_log=True
+# $ torchrun --nproc_per_node=8 --nnodes=2 ... train.py config/train_gpt2.py config/ddp_powersgd.py --out_dir=out-powersgd \
+#       --loss_reference=out/loss.jsonl
+# for a cheaper, safer 2x, use ddp_comm_hook = 'bf16' ('fp16' if your gloo build can't all-reduce bfloat16)
+
+ddp_comm_hook = 'powersgd'
+powersgd_rank = 4 # higher is closer to the uncompressed gradient, and sends more bytes
+powersgd_start_iter = 1000 # plain all-reduce through the lr warmup
+wandb_run_name = 'gpt2-124M-powersgd'
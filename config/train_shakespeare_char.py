@@ -37,3 +37,9 @@ warmup_iters = 100 # not super necessary potentially
 # on macbook also add
 # device = 'cpu'  # run on cpu only
 # compile = False # do not torch compile the model
+
+# data parallel on the cores of a CPU box (each rank gets its own cores), measured against a single process.
+# both runs do the same 16384 tokens per iteration, in 4 micro steps of B=16 or 4 ranks of B=16:
+# $ python train.py config/train_shakespeare_char.py --device=cpu --compile=False --max_iters=50 --cpu_threads_per_rank=8 --B=16
+# $ torchrun --standalone --nproc_per_node=4 train.py config/train_shakespeare_char.py --device=cpu --backend=gloo \
+#       --compile=False --max_iters=50 --cpu_threads_per_rank=8 --B=16 --scaling_baseline=<tok/sec of the first run, e.g. 20000.0>
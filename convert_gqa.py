@@ -0,0 +1,54 @@
+"""
+Convert a multi-head attention checkpoint into a grouped-query attention (GQA) one, to be
+finetuned from. The keys and values of every group of n_head // n_kv_head consecutive heads
+are mean-pooled into one shared head (https://arxiv.org/abs/2305.13245), queries are kept.
+Example:
+$ python convert_gqa.py --in_dir=out --out_dir=out-gqa --n_kv_head=4
+$ python train.py --init_from=out-gqa/ckpt.pt ...
+The optimizer state is dropped, as its shapes no longer match the model.
+"""
+import os
+
+import torch
+
+def mean_pool_kv(w, n_embd, n_head, n_kv_head):
+    """ pool the k and v parts of a c_attn weight (3*C, C) or bias (3*C,) down to n_kv_head heads """
+    q, k, v = w.split(n_embd, dim=0)
+    hs = n_embd // n_head
+    group = n_head // n_kv_head
+    pool = lambda t: t.reshape(n_kv_head, group, hs, *t.shape[1:]).mean(dim=1).reshape(n_kv_head * hs, *t.shape[1:])
+    return torch.cat([q, pool(k), pool(v)], dim=0)
+
+# -----------------------------------------------------------------------------
+in_dir = 'out' # directory holding the ckpt.pt to convert
+out_dir = 'out-gqa'
+n_kv_head = 1 # number of key/value heads of the converted model, must divide n_head (1 = multi-query attention)
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+checkpoint = torch.load(os.path.join(in_dir, 'ckpt.pt'), map_location='cpu')
+model_args = dict(checkpoint['model_args'])
+n_head, n_embd = model_args['n_head'], model_args['n_embd']
+assert model_args.get('n_kv_head', 0) in (0, n_head), "checkpoint already uses grouped-query attention"
+assert n_head % n_kv_head == 0, f"n_kv_head={n_kv_head} must divide n_head={n_head}"
+
+state_dict = checkpoint['model']
+unwanted_prefix = '_orig_mod.'
+for k,v in list(state_dict.items()):
+    if k.startswith(unwanted_prefix):
+        state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+for k in list(state_dict.keys()):
+    if k.endswith('attn.c_attn.weight') or k.endswith('attn.c_attn.bias'):
+        state_dict[k] = mean_pool_kv(state_dict[k], n_embd, n_head, n_kv_head)
+model_args['n_kv_head'] = n_kv_head
+
+os.makedirs(out_dir, exist_ok=True)
+out_path = os.path.join(out_dir, 'ckpt.pt')
+torch.save({
+    'model': state_dict,
+    'model_args': model_args,
+    'iter_num': 0,
+    'best_val_loss': 1e9,
+    'config': checkpoint.get('config', {}),
+}, out_path)
+print(f"converted {n_head} heads to {n_kv_head} key/value heads, saved to {out_path}")
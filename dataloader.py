@@ -0,0 +1,171 @@
+"""
+Background-prefetching batch loader for the uint16 token files (train.bin / val.bin) written
+by the data/*/prepare.py scripts.
+
+A worker thread samples random windows and writes them, several batches ahead of the training
+loop, into a small pool of preallocated (pinned, when on cuda) buffers that get recycled. Each
+batch is read with one vectorized gather of B windows of T+1 tokens, so that x and y are just
+views of the same buffer, shifted by one token.
+"""
+import time
+import queue
+import threading
+from collections import deque
+
+import numpy as np
+import torch
+
+def random_offsets(n_tokens, B, T, generator=None, sort=False):
+    """ B random window start offsets into a file of n_tokens tokens, each window holding T+1 tokens """
+    ix = torch.randint(n_tokens - T, (B,), generator=generator)
+    if sort:
+        # visiting the windows in file order is kinder to the page cache and readahead of large files
+        ix, _ = torch.sort(ix)
+    return ix
+
+def gather_windows(data, ix, T, out):
+    """ read the windows data[i:i+T+1] for all i in ix with a single gather, widened into out (B, T+1) int64 """
+    idx = ix[:, None] + np.arange(T + 1) # (B, T+1) token indices
+    np.copyto(out.numpy(), data[idx]) # uint16 -> int64 straight into the preallocated buffer
+
+def contiguous_windows(path, T, rank=0, world_size=1, device='cpu', max_windows=0):
+    """
+    x, y (N, T) of all non-overlapping T-token windows of a token file (uint16 .bin, or a .npy shard), in
+    file order, for a full sweep over it (e.g. for evaluation). max_windows > 0: only the first this many.
+    With world_size > 1 only rank's contiguous share of the windows.
+    """
+    data = np.load(path, mmap_mode='r') if path.endswith('.npy') else np.memmap(path, dtype=np.uint16, mode='r')
+    num_windows = (len(data) - 1) // T
+    if max_windows > 0:
+        num_windows = min(num_windows, max_windows)
+    lo, hi = num_windows * rank // world_size, num_windows * (rank + 1) // world_size
+    tokens = torch.from_numpy(data[lo * T:hi * T + 1].astype(np.int64)).to(device)
+    # x and y are views of the same tokens, shifted by one
+    return tokens[:-1].view(-1, T), tokens[1:].view(-1, T)
+
+class EpochSampler:
+    """
+    Deterministic, resumable sampler of non-overlapping T-token windows. Every epoch is a seeded
+    permutation of all windows of the file, and every (global) step hands the next B windows of it
+    to each of the world_size ranks, so each token is trained on exactly once per epoch. The whole
+    state is a cursor into the permutation, which does not depend on the number of ranks.
+    """
+
+    def __init__(self, n_tokens, B, T, rank=0, world_size=1, seed=1337):
+        # window k is tokens k*T .. k*T+T, the last one only serving as a target
+        self.num_windows = (n_tokens - 1) // T
+        assert self.num_windows >= B * world_size, "not enough data for a single step"
+        self.B, self.T = B, T
+        self.rank, self.world_size = rank, world_size
+        self.seed = seed
+        self.epoch = 0
+        self.cursor = 0 # number of windows of this epoch's permutation consumed by all ranks together
+        self.perm, self.perm_epoch = None, None
+
+    def next_offsets(self):
+        step = self.B * self.world_size
+        if self.cursor + step > self.num_windows:
+            # not enough windows left for a full step on every rank, the (< step) leftovers are skipped
+            self.epoch += 1
+            self.cursor = 0
+        if self.perm_epoch != self.epoch:
+            g = torch.Generator().manual_seed(self.seed + self.epoch)
+            self.perm, self.perm_epoch = torch.randperm(self.num_windows, generator=g), self.epoch
+        start = self.cursor + self.rank * self.B
+        self.cursor += step
+        return self.perm[start:start + self.B] * self.T
+
+    def state_dict(self):
+        return dict(epoch=self.epoch, cursor=self.cursor, seed=self.seed, T=self.T)
+
+    def load_state_dict(self, state):
+        assert state['T'] == self.T and state['seed'] == self.seed, "sampler state was saved with a different T or seed"
+        self.epoch, self.cursor = state['epoch'], state['cursor']
+
+class BatchLoader:
+
+    def __init__(self, path, B, T, device, prefetch=4, seed=1337, sort_offsets=False, sampler=None):
+        self.path = path
+        self.B, self.T = B, T
+        self.device = device
+        self.cuda = 'cuda' in str(device)
+        self.prefetch = prefetch # batches kept ready by the worker thread, 0 = load synchronously in next_batch
+        self.sort_offsets = sort_offsets
+        # optional EpochSampler to draw the window offsets from, instead of uniformly random ones
+        self.sampler = sampler
+        self.sampler_state = sampler.state_dict() if sampler is not None else None
+        self.generator = torch.Generator().manual_seed(seed) # own generator, the global RNG belongs to the training thread
+        # the training loop may still use the last 2 batches (the current one, and the previous one
+        # whose backward pass needs its indices), so those buffers are only recycled after that
+        self.hold = 2
+        self.free = queue.Queue()
+        for _ in range(prefetch + self.hold + 1):
+            self.free.put((torch.empty((B, T + 1), dtype=torch.int64, pin_memory=self.cuda), None))
+        self.ready = queue.Queue()
+        self.in_use = deque()
+        self.wait_time = 0.0 # seconds the training loop spent blocked in next_batch, see pop_wait_time
+        if prefetch > 0:
+            threading.Thread(target=self._worker, daemon=True).start()
+
+    def _fill(self):
+        buf, event = self.free.get()
+        if event is not None:
+            # the asynchronous host-to-device copy out of this buffer has to finish before we overwrite it
+            event.synchronize()
+        # We recreate np.memmap every batch to avoid a memory leak, as per
+        # https://stackoverflow.com/questions/45132940/numpy-memmap-memory-usage-want-to-iterate-once/61472122#61472122
+        data = np.memmap(self.path, dtype=np.uint16, mode='r')
+        if self.sampler is not None:
+            # remember the sampler state from before this batch: resuming from it reproduces the batch
+            state = self.sampler.state_dict()
+            ix = self.sampler.next_offsets()
+            if self.sort_offsets:
+                ix, _ = torch.sort(ix)
+        else:
+            state = None
+            ix = random_offsets(len(data), self.B, self.T, self.generator, sort=self.sort_offsets)
+        gather_windows(data, ix.numpy(), self.T, buf)
+        return buf, ix, state
+
+    def _worker(self):
+        while True:
+            try:
+                self.ready.put(self._fill())
+            except Exception as e:
+                # e.g. a file too small for a window, or an IO error: hand it to next_batch to raise
+                # in the training thread, instead of dying silently and leaving next_batch waiting forever
+                self.ready.put(e)
+                return
+
+    def next_batch(self):
+        t0 = time.perf_counter()
+        batch = self.ready.get() if self.prefetch > 0 else self._fill()
+        self.wait_time += time.perf_counter() - t0
+        if isinstance(batch, Exception):
+            self.ready.put(batch) # every later call fails the same way
+            raise batch
+        buf, ix, self.sampler_state = batch
+        if self.cuda:
+            # one async copy of the pinned (B, T+1) buffer, x and y are views of it on the device
+            buf_device = buf.to(self.device, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+            self.in_use.append((buf, event))
+            if len(self.in_use) > self.hold:
+                self.free.put(self.in_use.popleft())
+        else:
+            # on the CPU .to() would return the pooled buffer itself, which the worker overwrites as soon
+            # as it is recycled, however long the caller holds on to the batch. hand out a copy instead
+            buf_device = buf.to(self.device, copy=True)
+            self.free.put((buf, None))
+        return buf_device[:, :-1], buf_device[:, 1:], ix
+
+    def pop_wait_time(self):
+        # time spent waiting on data since the last call
+        wait_time, self.wait_time = self.wait_time, 0.0
+        return wait_time
+
+    def state_dict(self):
+        # sampler state from right before the most recently returned batch, i.e. the batch the training loop
+        # is about to train on is the first one drawn after resuming. the worker may be further ahead already
+        return self.sampler_state
@@ -0,0 +1,210 @@
+"""
+Out-of-process evaluator: watches a training run's checkpoint directory and evaluates every new
+checkpoint as it appears (val loss, multiple-choice accuracy, samples), on spare cores or a spare
+device, so the training loop itself only has to write checkpoints.
+
+Checkpoints of train.py (out_dir/ckpt.pt, ckpt_{iter}.pt) and of train_gpt2.py (log/model_*.pt) are
+both understood. The results are appended to the run's metrics log: eval_log.jsonl (one JSON
+object per checkpoint), or log.txt in train_gpt2.py's format if the watched directory has one,
+as 'eval_val' / 'eval_hella' rows that can't be mistaken for the training loop's 'val' / 'hella'.
+
+ckpt.pt gets overwritten, so only the newest one is seen if checkpoints come faster than they
+are evaluated, keep them all with train.py's snapshot_interval.
+
+Next to a train.py run on the GPUs, on 8 otherwise idle cores:
+$ python train.py --eval_inline=False ...
+$ python evaluator.py --watch_dir=out --device=cpu --cores=24-31
+Evaluate what is there once and exit:
+$ python evaluator.py --watch_dir=log --once=True
+"""
+import os
+import re
+import json
+import time
+import pickle
+from contextlib import nullcontext
+
+import torch
+import tiktoken
+
+from model import GPTConfig, GPT
+from dataloader import contiguous_windows
+import hellaswag
+
+# -----------------------------------------------------------------------------
+watch_dir = 'out' # train.py's out_dir, or train_gpt2.py's log dir
+poll_interval = 30 # seconds between looks for new checkpoints
+settle_time = 10 # seconds a checkpoint file has to stay unchanged before it is read (train_gpt2.py does not write atomically)
+once = False # evaluate the checkpoints already there, then exit
+val_data = '' # token file for the val loss, .bin (uint16) or .npy shard. default: data/{dataset}/val.bin of the run
+val_tokens = 2**20 # number of val tokens to evaluate, in contiguous windows from the start, 0 = all of them
+batch_size = 8 # windows per forward pass for the val loss, examples per forward pass for the multiple-choice eval
+mc_path = '' # JSONL of multiple-choice examples, default hellaswag/hellaswag_val.jsonl (skipped if it doesn't exist)
+mc_max_examples = 0 # > 0: only evaluate the first this many examples
+num_samples = 2 # samples to draw, 0 = none
+sample_start = "\n" # prompt of the samples
+max_new_tokens = 64
+temperature = 0.8
+top_k = 200
+seed = 1337
+device = 'cpu' # a spare device, e.g. 'cuda:7', or 'cpu'
+cores = '' # with device='cpu': cores to pin to, with as many threads, e.g. --cores=24-31. a list or a single core has to be quoted to stay a string: --cores="'0,2,4'". '' = leave as is
+dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32', 'bfloat16', or 'float16'
+exec(open('configurator.py').read()) # overrides from command line or config file
+# -----------------------------------------------------------------------------
+
+if cores:
+    core_ids = []
+    for part in cores.split(','):
+        lo, _, hi = part.partition('-')
+        core_ids.extend(range(int(lo), int(hi or lo) + 1))
+    os.sched_setaffinity(0, core_ids)
+    torch.set_num_threads(len(core_ids))
+    print(f"pinned to cores {core_ids}")
+device_type = 'cuda' if 'cuda' in device else 'cpu' # for later use in torch.autocast
+ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torch.float16}[dtype]
+ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
+
+def list_checkpoints():
+    # (path, mtime) of the complete checkpoints in watch_dir, skipping optimizer shards, int8 copies and temporary files
+    found = []
+    for f in os.listdir(watch_dir):
+        if re.fullmatch(r'ckpt(_\d+)?\.pt|model_\d+\.pt', f):
+            path = os.path.join(watch_dir, f)
+            mtime = os.path.getmtime(path)
+            if time.time() - mtime >= settle_time:
+                found.append((path, mtime))
+    return sorted(found, key=lambda p: p[1])
+
+def load_checkpoint(path):
+    # our own checkpoints, trusted. train_gpt2.py pickles its GPTConfig, which unpickles as model.GPTConfig
+    # (it lived in train_gpt2's __main__, and so does the GPTConfig imported above)
+    checkpoint = torch.load(path, map_location='cpu', weights_only=False)
+    if 'model_args' in checkpoint:
+        # train.py
+        model_args = dict(checkpoint['model_args'])
+        step = checkpoint['iter_num']
+        dataset = checkpoint.get('config', {}).get('dataset', '')
+    else:
+        # train_gpt2.py, evaluated with model.py's GPT set up as the same function: biases and tanh GELU
+        cfg = checkpoint['config']
+        model_args = dict(n_layer=cfg.n_layer, n_head=cfg.n_head, n_embd=cfg.n_embd, block_size=cfg.block_size,
+                          vocab_size=cfg.vocab_size, bias=True, gelu_approximate='tanh')
+        step = checkpoint['step']
+        dataset = ''
+    model_args['dropout'] = 0.0
+    state_dict = checkpoint['model']
+    unwanted_prefix = '_orig_mod.'
+    for k,v in list(state_dict.items()):
+        if k.startswith(unwanted_prefix):
+            state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+    model = GPT.from_state_dict(GPTConfig(**model_args), state_dict)
+    model.eval()
+    model.to(device)
+    return model, step, dataset
+
+@torch.no_grad()
+def val_loss(model, path):
+    T = model.config.block_size
+    X, Y = contiguous_windows(path, T, max_windows=max(1, val_tokens // T) if val_tokens > 0 else 0)
+    num_windows = X.size(0)
+    loss_sum = torch.zeros((), device=device)
+    for i in range(0, num_windows, batch_size):
+        x, y = X[i:i+batch_size].to(device), Y[i:i+batch_size].to(device)
+        with ctx:
+            _, loss = model(x, y)
+        loss_sum += loss.float() * y.numel()
+    return loss_sum.item() / (num_windows * T)
+
+def get_codec(dataset):
+    # encode/decode of the run's tokenizer, the char-level meta.pkl of the dataset if there is one, else GPT-2
+    meta_path = os.path.join('data', dataset, 'meta.pkl')
+    if dataset and os.path.exists(meta_path):
+        with open(meta_path, 'rb') as f:
+            meta = pickle.load(f)
+        stoi, itos = meta['stoi'], meta['itos']
+        return (lambda s: [stoi[c] for c in s]), (lambda l: ''.join([itos[i] for i in l]))
+    enc = tiktoken.get_encoding("gpt2")
+    return (lambda s: enc.encode(s, allowed_special={"<|endoftext|>"})), enc.decode
+
+@torch.no_grad()
+def draw_samples(model, dataset):
+    encode, decode = get_codec(dataset)
+    x = torch.tensor(encode(sample_start), dtype=torch.long, device=device)[None, ...]
+    generator = torch.Generator(device=device).manual_seed(seed)
+    samples = []
+    for _ in range(num_samples):
+        with ctx:
+            y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k, generator=generator)
+        samples.append(decode(y[0].tolist()))
+    return samples
+
+def evaluate(model, step, dataset, path):
+    t0 = time.time()
+    results = {'checkpoint': os.path.basename(path), 'step': step}
+    val_path = val_data or (os.path.join('data', dataset, 'val.bin') if dataset else '')
+    if val_path and os.path.exists(val_path):
+        results['val_loss'] = val_loss(model, val_path)
+    mc_file = mc_path or os.path.join(hellaswag.DATA_DIR, "hellaswag_val.jsonl")
+    # the multiple-choice examples are GPT-2 BPE tokens, meaningless (and out of range) for e.g. a char-level run
+    gpt2_tokens = model.config.vocab_size >= 50257 and not (dataset and os.path.exists(os.path.join('data', dataset, 'meta.pkl')))
+    if os.path.exists(mc_file) and gpt2_tokens:
+        examples = list(hellaswag.iterate_examples("val", mc_file))
+        if mc_max_examples > 0:
+            examples = examples[:mc_max_examples]
+        acc, acc_norm, _ = hellaswag.evaluate(lambda tokens: model(tokens, all_logits=True)[0],
+                                              hellaswag.render_examples(examples), device, batch_size, ctx=ctx)
+        results['mc_acc'], results['mc_acc_norm'] = acc, acc_norm
+    if num_samples > 0:
+        results['samples'] = draw_samples(model, dataset)
+    results['eval_time'] = time.time() - t0
+    return results
+
+def append_results(results):
+    step = results['step']
+    log_txt = os.path.join(watch_dir, 'log.txt')
+    if os.path.exists(log_txt):
+        # train_gpt2.py's format, next to the lines the training loop writes. those are measured on other
+        # tokens (val_tokens here vs train_gpt2's val_loss_steps batches), so ours get a tag of their own
+        with open(log_txt, 'a') as f:
+            if 'val_loss' in results:
+                f.write(f"{step} eval_val {results['val_loss']:.4f}\n")
+            if 'mc_acc_norm' in results:
+                f.write(f"{step} eval_hella {results['mc_acc_norm']:.4f}\n")
+    else:
+        with open(os.path.join(watch_dir, 'eval_log.jsonl'), 'a') as f:
+            f.write(json.dumps(results) + "\n")
+
+evaluated = set() # (path, mtime) of the checkpoints done, ckpt.pt gets overwritten with newer ones
+evaluated_steps = set() # ckpt.pt and ckpt_{iter}.pt are often the same checkpoint
+while True:
+    for path, mtime in list_checkpoints():
+        if (path, mtime) in evaluated:
+            continue
+        evaluated.add((path, mtime))
+        try:
+            model, step, dataset = load_checkpoint(path)
+        except Exception as e:
+            # e.g. the file got replaced while we read it, it is picked up again with its new mtime
+            print(f"could not load {path}: {e}")
+            continue
+        if step in evaluated_steps:
+            continue
+        evaluated_steps.add(step)
+        try:
+            results = evaluate(model, step, dataset, path)
+        except Exception as e:
+            # a checkpoint we can't evaluate shouldn't take the watcher down with it
+            print(f"could not evaluate {path}: {e}")
+            continue
+        finally:
+            model = None # free up memory
+        summary = ', '.join(f"{k} {v:.4f}" for k, v in results.items() if isinstance(v, float))
+        print(f"step {results['step']} ({results['checkpoint']}): {summary}")
+        for sample in results.get('samples', []):
+            print(sample)
+            print('---------------')
+        append_results(results)
+    if once:
+        break
+    time.sleep(poll_interval)
@@ -0,0 +1,139 @@
+"""
+Batched multiple-choice evaluation in the style of HellaSwag (https://arxiv.org/abs/1905.07830):
+every example is a context with a few candidate endings, and the model picks the ending it
+finds most likely, i.e. with the lowest loss over the ending's tokens.
+
+Examples are read from a local JSONL file, one {"ctx": ..., "endings": [...], "label": ...} per
+line, e.g. the HellaSwag val split, downloaded once into hellaswag/ next to this file:
+https://raw.githubusercontent.com/rowanz/hellaswag/master/data/hellaswag_val.jsonl
+Many examples are packed into one right-padded batch, and the losses of all their endings are
+scored at once with masks. Examples are sharded across DDP ranks, results summed in one all_reduce.
+
+Evaluate a model directly, e.g. on a small file on CPU:
+$ python hellaswag.py --init_from=gpt2 --path=my_examples.jsonl --device=cpu
+"""
+import os
+import json
+from contextlib import nullcontext
+
+import torch
+from torch.nn import functional as F
+import torch.distributed as dist
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "hellaswag")
+
+_enc = None
+def get_encoder():
+    global _enc
+    if _enc is None:
+        import tiktoken
+        _enc = tiktoken.get_encoding("gpt2")
+    return _enc
+
+def iterate_examples(split, path=None):
+    # the examples of hellaswag/hellaswag_{split}.jsonl, or of the JSONL file at path
+    path = path or os.path.join(DATA_DIR, f"hellaswag_{split}.jsonl")
+    with open(path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def render_example(example):
+    """
+    tokens (num_endings, L) of the context followed by each of the endings (right-padded with 0),
+    mask (num_endings, L) that is 1 over the ending tokens, and the index of the correct ending
+    """
+    enc = get_encoder()
+    ctx_tokens = enc.encode(example["ctx"])
+    rows = []
+    for end in example["endings"]:
+        end_tokens = enc.encode(" " + end) # prepend " " because GPT-2 tokenizer
+        rows.append((ctx_tokens + end_tokens, [0] * len(ctx_tokens) + [1] * len(end_tokens)))
+    max_len = max(len(row) for row, _ in rows)
+    tokens = torch.zeros((len(rows), max_len), dtype=torch.long)
+    mask = torch.zeros((len(rows), max_len), dtype=torch.long)
+    for i, (row, row_mask) in enumerate(rows):
+        tokens[i, :len(row)] = torch.tensor(row)
+        mask[i, :len(row_mask)] = torch.tensor(row_mask)
+    data = {"ctx_tokens": ctx_tokens, "label": example["label"]}
+    return data, tokens, mask, example["label"]
+
+def render_examples(examples, rank=0, world_size=1):
+    """ render this rank's share (every world_size-th) of examples, once, to be evaluated any number of times """
+    rendered = [render_example(example)[1:] for i, example in enumerate(examples) if i % world_size == rank]
+    # examples of similar length end up in the same batch, so there is little padding
+    rendered.sort(key=lambda r: r[0].size(1))
+    return rendered
+
+@torch.no_grad()
+def evaluate(logits_fn, rendered, device, batch_size=16, world_size=1, ctx=nullcontext()):
+    """
+    accuracy over the rendered examples of all ranks, picking the ending with the lowest summed (acc)
+    and the lowest per-token (acc_norm) loss. logits_fn maps tokens (B, L) to logits (B, L, vocab_size).
+    returns acc, acc_norm, num_examples
+    """
+    stats = torch.zeros(3, device=device) # correct by summed loss, correct by mean loss, examples
+    for i in range(0, len(rendered), batch_size):
+        batch = rendered[i:i+batch_size]
+        n = batch[0][0].size(0) # endings per example
+        assert all(tokens.size(0) == n for tokens, _, _ in batch), "all examples need the same number of endings"
+        L = max(tokens.size(1) for tokens, _, _ in batch)
+        tokens = torch.zeros((len(batch) * n, L), dtype=torch.long)
+        mask = torch.zeros((len(batch) * n, L))
+        for j, (t, m, _) in enumerate(batch):
+            tokens[j*n:(j+1)*n, :t.size(1)] = t
+            mask[j*n:(j+1)*n, :m.size(1)] = m
+        labels = torch.tensor([label for _, _, label in batch])
+        tokens, mask, labels = tokens.to(device), mask.to(device), labels.to(device)
+        with ctx:
+            logits = logits_fn(tokens)
+        # the loss of predicting every next token, kept only over the endings
+        losses = F.cross_entropy(logits[:, :-1].float().reshape(-1, logits.size(-1)), tokens[:, 1:].reshape(-1),
+                                 reduction='none').view(tokens.size(0), -1)
+        shift_mask = mask[:, 1:] # we must shift mask, so we start at the last prompt token
+        sum_loss = (losses * shift_mask).sum(dim=1)
+        avg_loss = sum_loss / shift_mask.sum(dim=1)
+        stats[0] += (sum_loss.view(-1, n).argmin(dim=1) == labels).sum()
+        stats[1] += (avg_loss.view(-1, n).argmin(dim=1) == labels).sum()
+        stats[2] += len(batch)
+    if world_size > 1:
+        dist.all_reduce(stats)
+    num_correct, num_correct_norm, num_total = stats.tolist()
+    return num_correct / num_total, num_correct_norm / num_total, int(num_total)
+
+if __name__ == '__main__':
+    import time
+
+    # -----------------------------------------------------------------------------
+    init_from = 'gpt2' # a gpt2 variant (e.g. 'gpt2-xl'), or 'resume' to evaluate out_dir/ckpt.pt
+    out_dir = 'out'
+    path = '' # JSONL file to evaluate on, defaults to hellaswag/hellaswag_val.jsonl
+    max_examples = 0 # > 0: only evaluate the first this many examples
+    batch_size = 16 # examples per forward pass, i.e. batch_size * num_endings rows
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+
+    from model import GPTConfig, GPT
+    if init_from == 'resume':
+        checkpoint = torch.load(os.path.join(out_dir, 'ckpt.pt'), map_location=device)
+        model = GPT(GPTConfig(**checkpoint['model_args']))
+        state_dict = checkpoint['model']
+        unwanted_prefix = '_orig_mod.'
+        for k,v in list(state_dict.items()):
+            if k.startswith(unwanted_prefix):
+                state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+        model.load_state_dict(state_dict)
+        checkpoint = None # free up memory
+    else:
+        model = GPT.from_pretrained(init_from, dict(dropout=0.0))
+    model.eval()
+    model.to(device)
+
+    examples = list(iterate_examples("val", path or None))
+    if max_examples > 0:
+        examples = examples[:max_examples]
+    rendered = render_examples(examples)
+    t0 = time.time()
+    acc, acc_norm, num_total = evaluate(lambda tokens: model(tokens, all_logits=True)[0], rendered, device, batch_size)
+    print(f"{num_total} examples in {time.time()-t0:.2f}s: acc {acc:.4f}, acc_norm {acc_norm:.4f}")
@@ -14,6 +14,7 @@ from dataclasses import dataclass
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 
 class LayerNorm(nn.Module):
     """ LayerNorm but with an optional bias. PyTorch doesn't support simply bias=False """
@@ -31,8 +32,12 @@ class CausalSelfAttention(nn.Module):
     def __init__(self, config):
         super().__init__()
         assert config.n_embd % config.n_head == 0
+        # grouped-query attention: n_kv_head key/value heads are shared by groups of n_head // n_kv_head query heads
+        self.n_kv_head = config.n_kv_head or config.n_head
+        assert config.n_head % self.n_kv_head == 0
+        self.kv_dim = self.n_kv_head * (config.n_embd // config.n_head)
         # key, query, value projections for all heads, but in a batch
-        self.c_attn = nn.Linear(config.n_embd, 3 * config.n_embd, bias=config.bias)
+        self.c_attn = nn.Linear(config.n_embd, config.n_embd + 2 * self.kv_dim, bias=config.bias)
         # output projection
         self.c_proj = nn.Linear(config.n_embd, config.n_embd, bias=config.bias)
         # regularization
@@ -43,32 +48,59 @@ class CausalSelfAttention(nn.Module):
         self.dropout = config.dropout
         # flash attention make GPU go brrrrr but support is only in PyTorch >= 2.0
         self.flash = hasattr(torch.nn.functional, 'scaled_dot_product_attention')
+        # since PyTorch 2.5 SDPA can attend grouped key/value heads itself, without expanding them
+        self.sdpa_gqa = self.flash and torch.__version__ >= '2.5'
         if not self.flash:
             print("WARNING: using slow attention. Flash Attention requires PyTorch >= 2.0")
             # causal mask to ensure that attention is only applied to the left in the input sequence
             self.register_buffer("bias", torch.tril(torch.ones(config.block_size, config.block_size))
                                         .view(1, 1, config.block_size, config.block_size))
 
-    def forward(self, x):
+    def forward(self, x, attn_mask=None, kv_cache=None, layer_idx=None):
         B, T, C = x.size() # batch size, sequence length, embedding dimensionality (n_embd)
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
-        q, k, v  = self.c_attn(x).split(self.n_embd, dim=2)
-        k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
+        q, k, v  = self.c_attn(x).split([self.n_embd, self.kv_dim, self.kv_dim], dim=2)
+        k = k.view(B, T, self.n_kv_head, C // self.n_head).transpose(1, 2) # (B, nkvh, T, hs)
         q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
-        v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2) # (B, nh, T, hs)
+        v = v.view(B, T, self.n_kv_head, C // self.n_head).transpose(1, 2) # (B, nkvh, T, hs)
+        if kv_cache is not None:
+            # incremental decoding: prepend the cached keys/values of earlier positions
+            k, v = kv_cache.update(layer_idx, k, v) # (B, nkvh, T_past + T, hs)
+        # every key/value head serves n_head // n_kv_head consecutive query heads
+        # (the cache above only ever holds the n_kv_head heads, and so should the attention read)
+        group = self.n_head // self.n_kv_head
+        fold = group > 1 and attn_mask is None and T == 1
+        gqa_kwargs = {}
+        if fold:
+            # a single new token attends to every cached position, so the group's query heads can take the
+            # place of query positions: (B, nkvh, group, hs) against the unexpanded (B, nkvh, T_past + 1, hs)
+            q = q.reshape(B, self.n_kv_head, group, C // self.n_head)
+        elif group > 1 and self.sdpa_gqa:
+            gqa_kwargs = dict(enable_gqa=True)
+        elif group > 1:
+            # fallback: copy out the key/value heads to all query heads
+            k = k.repeat_interleave(group, dim=1) # (B, nh, T_past + T, hs)
+            v = v.repeat_interleave(group, dim=1)
 
         # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
+        # without an explicit attn_mask we are either a plain causal pass over the whole sequence,
+        # or a single new token attending to everything in the cache (no masking needed at all)
         if self.flash:
             # efficient attention using Flash Attention CUDA kernels
-            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=None, dropout_p=self.dropout if self.training else 0, is_causal=True)
+            y = torch.nn.functional.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=self.dropout if self.training else 0, is_causal=(attn_mask is None and T > 1), **gqa_kwargs)
         else:
             # manual implementation of attention
             att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-            att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
+            if attn_mask is not None:
+                att = att.masked_fill(~attn_mask, float('-inf'))
+            elif T > 1:
+                att = att.masked_fill(self.bias[:,:,:T,:T] == 0, float('-inf'))
             att = F.softmax(att, dim=-1)
             att = self.attn_dropout(att)
             y = att @ v # (B, nh, T, T) x (B, nh, T, hs) -> (B, nh, T, hs)
+        if fold:
+            y = y.reshape(B, self.n_head, 1, C // self.n_head) # unfold the query heads again
         y = y.transpose(1, 2).contiguous().view(B, T, C) # re-assemble all head outputs side by side
 
         # output projection
@@ -80,7 +112,7 @@ class MLP(nn.Module):
     def __init__(self, config):
         super().__init__()
         self.c_fc    = nn.Linear(config.n_embd, 4 * config.n_embd, bias=config.bias)
-        self.gelu    = nn.GELU()
+        self.gelu    = nn.GELU(approximate=config.gelu_approximate)
         self.c_proj  = nn.Linear(4 * config.n_embd, config.n_embd, bias=config.bias)
         self.dropout = nn.Dropout(config.dropout)
 
@@ -93,27 +125,173 @@ class MLP(nn.Module):
 
 class Block(nn.Module):
 
-    def __init__(self, config):
+    def __init__(self, config, layer_idx=0):
         super().__init__()
         self.ln_1 = LayerNorm(config.n_embd, bias=config.bias)
         self.attn = CausalSelfAttention(config)
         self.ln_2 = LayerNorm(config.n_embd, bias=config.bias)
         self.mlp = MLP(config)
-
-    def forward(self, x):
-        x = x + self.attn(self.ln_1(x))
+        # activation recomputation: instead of keeping its activations around for the backward pass,
+        # re-run the whole block ('block') or just its attention ('attn') during backward
+        assert config.recompute in {'none', 'all', 'every_n', 'attn'}
+        self.recompute = {
+            'none': None,
+            'all': 'block',
+            'every_n': 'block' if layer_idx % config.recompute_every_n == 0 else None,
+            'attn': 'attn',
+        }[config.recompute]
+
+    def forward(self, x, attn_mask=None, kv_cache=None, layer_idx=None):
+        # recomputation only makes sense when training, i.e. never together with a KV cache
+        recompute = self.recompute if self.training and kv_cache is None else None
+        if recompute == 'block':
+            return checkpoint(self._forward, x, attn_mask, use_reentrant=False)
+        return self._forward(x, attn_mask, kv_cache, layer_idx, recompute_attn=(recompute == 'attn'))
+
+    def _attn(self, x, attn_mask=None, kv_cache=None, layer_idx=None):
+        return self.attn(self.ln_1(x), attn_mask=attn_mask, kv_cache=kv_cache, layer_idx=layer_idx)
+
+    def _forward(self, x, attn_mask=None, kv_cache=None, layer_idx=None, recompute_attn=False):
+        if recompute_attn:
+            x = x + checkpoint(self._attn, x, attn_mask, use_reentrant=False)
+        else:
+            x = x + self._attn(x, attn_mask, kv_cache, layer_idx)
         x = x + self.mlp(self.ln_2(x))
         return x
 
+class ChunkedCrossEntropy(torch.autograd.Function):
+    """
+    Cross-entropy of x @ weight.T against targets, computed chunk_size rows at a time so that the
+    full (N, vocab_size) logits never exist at once. As the loss is a scalar, the gradients w.r.t.
+    x and weight are produced chunk by chunk during the forward pass already and backward only
+    rescales them by the incoming gradient.
+    """
+
+    @staticmethod
+    def forward(ctx, x, weight, targets, chunk_size, ignore_index, needs_grad):
+        n_valid = (targets != ignore_index).sum().clamp(min=1)
+        loss = torch.zeros((), dtype=torch.float32, device=x.device)
+        grad_x = torch.zeros_like(x) if needs_grad else None
+        grad_w = torch.zeros_like(weight, dtype=torch.float32) if needs_grad else None
+        for i in range(0, x.size(0), chunk_size):
+            x_c, t_c = x[i:i+chunk_size], targets[i:i+chunk_size]
+            logits = (x_c @ weight.t()).float() # (chunk_size, vocab_size), the only logits held at a time
+            valid = t_c != ignore_index
+            t_c = t_c.masked_fill(~valid, 0)
+            lse = torch.logsumexp(logits, dim=-1)
+            loss += ((lse - logits.gather(1, t_c[:, None]).squeeze(1)) * valid).sum()
+            if needs_grad:
+                # d(loss)/d(logits) = (softmax - onehot) / n_valid, zero for ignored positions
+                dlogits = torch.exp(logits - lse[:, None])
+                dlogits[torch.arange(t_c.size(0), device=x.device), t_c] -= 1.0
+                dlogits *= (valid / n_valid)[:, None]
+                grad_x[i:i+chunk_size] = dlogits @ weight.float()
+                grad_w += dlogits.t() @ x_c.float()
+        ctx.weight_dtype = weight.dtype
+        ctx.save_for_backward(grad_x, grad_w)
+        return loss / n_valid
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        grad_x, grad_w = ctx.saved_tensors
+        return grad_x * grad_output, (grad_w * grad_output).to(ctx.weight_dtype), None, None, None, None
+
+def chunked_cross_entropy(x, weight, targets, chunk_size, ignore_index=-1):
+    """ F.cross_entropy(x @ weight.T, targets) without materializing the full logits, x is (N, C) """
+    needs_grad = torch.is_grad_enabled() and (x.requires_grad or weight.requires_grad)
+    return ChunkedCrossEntropy.apply(x, weight, targets, chunk_size, ignore_index, needs_grad)
+
+class KVCache:
+    """
+    Key/value cache for incremental decoding, holding the keys and values of every Block.
+    With prealloc=True the buffers are allocated once (lazily, on the first update, so that
+    they pick up the batch size, device and autocast dtype of the keys) at max_len positions
+    and written in place; otherwise they grow with a torch.cat on every step.
+    """
+
+    def __init__(self, n_layer, max_len, prealloc=True):
+        self.n_layer = n_layer
+        self.max_len = max_len
+        self.prealloc = prealloc
+        self.k = [None] * n_layer
+        self.v = [None] * n_layer
+        self.pos = 0 # number of positions currently held in the cache
+
+    def reset(self):
+        # forget the cached positions, but keep any preallocated buffers around for reuse
+        self.pos = 0
+        if not self.prealloc:
+            self.k = [None] * self.n_layer
+            self.v = [None] * self.n_layer
+
+    def truncate(self, pos):
+        # roll the cache back to its first pos positions, e.g. to drop rejected speculative tokens
+        assert pos <= self.pos
+        self.pos = pos
+        if not self.prealloc:
+            self.k = [k[:, :, :pos] if k is not None else None for k in self.k]
+            self.v = [v[:, :, :pos] if v is not None else None for v in self.v]
+
+    def update(self, layer_idx, k, v):
+        # append the (B, nh, T, hs) keys/values of the new positions for this layer and
+        # return the keys/values of all positions so far. the caller advances pos afterwards
+        end = self.pos + k.size(2)
+        assert end <= self.max_len, f"KV cache overflow: {end} > {self.max_len}"
+        if self.prealloc:
+            if self.k[layer_idx] is None:
+                B, nh, _, hs = k.size()
+                self.k[layer_idx] = k.new_empty(B, nh, self.max_len, hs)
+                self.v[layer_idx] = v.new_empty(B, nh, self.max_len, hs)
+            self.k[layer_idx][:, :, self.pos:end] = k
+            self.v[layer_idx][:, :, self.pos:end] = v
+            return self.k[layer_idx][:, :, :end], self.v[layer_idx][:, :, :end]
+        if self.pos > 0:
+            k = torch.cat((self.k[layer_idx], k), dim=2)
+            v = torch.cat((self.v[layer_idx], v), dim=2)
+        self.k[layer_idx], self.v[layer_idx] = k, v
+        return k, v
+
+class LazyHFStateDict:
+    """
+    Read-only view of a local HF GPT-2 checkpoint file (model.safetensors or pytorch_model.bin)
+    under the state_dict key names of GPT2LMHeadModel. The file is memory-mapped and every tensor
+    is only read when it is accessed.
+    """
+
+    def __init__(self, path):
+        if path.endswith('.safetensors'):
+            from safetensors import safe_open
+            f = safe_open(path, framework='pt', device='cpu')
+            raw_keys, self._get = list(f.keys()), f.get_tensor
+        else:
+            sd = torch.load(path, map_location='cpu', mmap=True, weights_only=True)
+            raw_keys, self._get = list(sd.keys()), sd.__getitem__
+        # the hub checkpoints hold the bare GPT2Model weights, without the 'transformer.' prefix
+        self._keys = {(k if k.startswith(('transformer.', 'lm_head.')) else 'transformer.' + k): k for k in raw_keys}
+
+    def keys(self):
+        return self._keys.keys()
+
+    def __contains__(self, k):
+        return k in self._keys
+
+    def __getitem__(self, k):
+        return self._get(self._keys[k])
+
 @dataclass
 class GPTConfig:
     block_size: int = 1024
     vocab_size: int = 50304 # GPT-2 vocab_size of 50257, padded up to nearest multiple of 64 for efficiency
     n_layer: int = 12
     n_head: int = 12
+    n_kv_head: int = 0 # key/value heads for grouped-query attention. 0: same as n_head, 1: multi-query attention
     n_embd: int = 768
     dropout: float = 0.0
     bias: bool = True # True: bias in Linears and LayerNorms, like GPT-2. False: a bit better and faster
+    loss_chunk_size: int = 0 # > 0: compute the training loss this many positions at a time, never holding the full logits
+    recompute: str = 'none' # activation recomputation in training: 'none', 'all' blocks, 'every_n' blocks or 'attn' only
+    recompute_every_n: int = 2 # with recompute='every_n', recompute blocks 0, n, 2n, ...
+    gelu_approximate: str = 'none' # 'none': exact GELU, like GPT-2. 'tanh': the approximation train_gpt2.py trains with
 
 class GPT(nn.Module):
 
@@ -127,7 +305,7 @@ class GPT(nn.Module):
             wte = nn.Embedding(config.vocab_size, config.n_embd),
             wpe = nn.Embedding(config.block_size, config.n_embd),
             drop = nn.Dropout(config.dropout),
-            h = nn.ModuleList([Block(config) for _ in range(config.n_layer)]),
+            h = nn.ModuleList([Block(config, i) for i in range(config.n_layer)]),
             ln_f = LayerNorm(config.n_embd, bias=config.bias),
         ))
         self.lm_head = nn.Linear(config.n_embd, config.vocab_size, bias=False)
@@ -137,12 +315,13 @@ class GPT(nn.Module):
         # not 100% sure what this is, so far seems to be harmless. TODO investigate
         self.transformer.wte.weight = self.lm_head.weight # https://paperswithcode.com/method/weight-tying
 
-        # init all weights
-        self.apply(self._init_weights)
-        # apply special scaled init to the residual projections, per GPT-2 paper
-        for pn, p in self.named_parameters():
-            if pn.endswith('c_proj.weight'):
-                torch.nn.init.normal_(p, mean=0.0, std=0.02/math.sqrt(2 * config.n_layer))
+        # init all weights, unless we are being built on the meta device to receive existing weights
+        if not self.lm_head.weight.is_meta:
+            self.apply(self._init_weights)
+            # apply special scaled init to the residual projections, per GPT-2 paper
+            for pn, p in self.named_parameters():
+                if pn.endswith('c_proj.weight'):
+                    torch.nn.init.normal_(p, mean=0.0, std=0.02/math.sqrt(2 * config.n_layer))
 
         # report number of parameters
         print("number of parameters: %.2fM" % (self.get_num_params()/1e6,))
@@ -159,6 +338,30 @@ class GPT(nn.Module):
             n_params -= self.transformer.wpe.weight.numel()
         return n_params
 
+    @classmethod
+    def from_state_dict(cls, config, state_dict):
+        """
+        Build a GPT whose weights will all come from state_dict without initializing them first:
+        the module is constructed on the meta device (no allocation, no random init) and its
+        parameters then simply become the state_dict tensors, on whatever device those live.
+        """
+        with torch.device('meta'):
+            model = cls(config)
+        model._assign_state_dict(state_dict)
+        return model
+
+    def _assign_state_dict(self, state_dict):
+        # load_state_dict(assign=True) swaps the (meta) parameters for the state_dict tensors instead of copying into them
+        missing, unexpected = self.load_state_dict(state_dict, strict=False, assign=True)
+        # the causal mask buffer of the slow attention path is not part of every state_dict
+        assert not unexpected and all(k.endswith('.attn.bias') for k in missing), f"missing: {missing}, unexpected: {unexpected}"
+        # assigning unties wte and lm_head, tie them again
+        self.transformer.wte.weight = self.lm_head.weight
+        for block in self.transformer.h:
+            if hasattr(block.attn, 'bias') and block.attn.bias.is_meta:
+                bs = self.config.block_size
+                block.attn.bias = torch.tril(torch.ones(bs, bs, device=self.lm_head.weight.device)).view(1, 1, bs, bs)
+
     def _init_weights(self, module):
         if isinstance(module, nn.Linear):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
@@ -167,24 +370,49 @@ class GPT(nn.Module):
         elif isinstance(module, nn.Embedding):
             torch.nn.init.normal_(module.weight, mean=0.0, std=0.02)
 
-    def forward(self, idx, targets=None):
+    def forward(self, idx, targets=None, kv_cache=None, pad=None, all_logits=False):
         device = idx.device
         b, t = idx.size()
-        assert t <= self.config.block_size, f"Cannot forward sequence of length {t}, block size is only {self.config.block_size}"
-        pos = torch.arange(0, t, dtype=torch.long, device=device) # shape (t)
+        past = kv_cache.pos if kv_cache is not None else 0 # positions already in the KV cache
+        assert past + t <= self.config.block_size, f"Cannot forward sequence of length {past + t}, block size is only {self.config.block_size}"
+        pos = torch.arange(past, past + t, dtype=torch.long, device=device) # shape (t)
+        # several new tokens on top of a non-empty cache (or a padded batch) need an explicit mask,
+        # otherwise the attention can rely on is_causal (or needs no mask at all for t == 1)
+        attn_mask = None
+        if pad is not None or (past > 0 and t > 1):
+            kpos = torch.arange(past + t, dtype=torch.long, device=device)
+            attn_mask = kpos[None, :] <= pos[:, None] # causal mask of shape (t, past + t)
+            if pad is not None:
+                # pad is a (b,) LongTensor with the number of left-padding tokens of every row.
+                # no query may attend to the pad keys of its row (a pad query still sees itself,
+                # which keeps its softmax finite), and positions count from the first real token
+                not_pad = (kpos[None, :] >= pad[:, None])[:, None, :] | (kpos[None, :] == pos[:, None])
+                attn_mask = (attn_mask & not_pad).unsqueeze(1) # (b, 1, t, past + t)
+                pos = (pos[None, :] - pad[:, None]).clamp(min=0) # shape (b, t)
 
         # forward the GPT model itself
         tok_emb = self.transformer.wte(idx) # token embeddings of shape (b, t, n_embd)
-        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (t, n_embd)
+        pos_emb = self.transformer.wpe(pos) # position embeddings of shape (t, n_embd) or (b, t, n_embd)
         x = self.transformer.drop(tok_emb + pos_emb)
-        for block in self.transformer.h:
-            x = block(x)
+        for i, block in enumerate(self.transformer.h):
+            x = block(x, attn_mask=attn_mask, kv_cache=kv_cache, layer_idx=i)
         x = self.transformer.ln_f(x)
-
-        if targets is not None:
+        if kv_cache is not None:
+            kv_cache.pos += t
+
+        if targets is not None and self.config.loss_chunk_size > 0:
+            # memory-saving loss: the (b, t, vocab_size) logits are never materialized, so none are returned
+            loss = chunked_cross_entropy(x.view(-1, x.size(-1)), self.lm_head.weight, targets.reshape(-1),
+                                         self.config.loss_chunk_size, ignore_index=-1)
+            logits = None
+        elif targets is not None:
             # if we are given some desired targets also calculate the loss
             logits = self.lm_head(x)
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1), ignore_index=-1)
+            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.reshape(-1), ignore_index=-1)
+        elif all_logits:
+            # e.g. verifying several speculative tokens at once needs the logits at every position
+            logits = self.lm_head(x)
+            loss = None
         else:
             # inference-time mini-optimization: only forward the lm_head on the very last position
             logits = self.lm_head(x[:, [-1], :]) # note: using list [-1] to preserve the time dim
@@ -204,12 +432,18 @@ class GPT(nn.Module):
                 block.attn.bias = block.attn.bias[:,:,:block_size,:block_size]
 
     @classmethod
-    def from_pretrained(cls, model_type, override_args=None):
+    def from_pretrained(cls, model_type, override_args=None, weights_path=None):
+        """
+        Load the OpenAI GPT-2 weights of model_type. By default they come from a full
+        huggingface/transformers GPT2LMHeadModel. With weights_path pointing to a local copy of
+        the HF checkpoint file instead (model.safetensors or pytorch_model.bin), the file is
+        memory-mapped and streamed tensor by tensor into the model, without transformers and
+        without a second full copy of the model in memory.
+        """
         assert model_type in {'gpt2', 'gpt2-medium', 'gpt2-large', 'gpt2-xl'}
         override_args = override_args or {} # default to empty dict
         # only dropout can be overridden see more notes below
         assert all(k == 'dropout' for k in override_args)
-        from transformers import GPT2LMHeadModel
         print("loading weights from pretrained gpt: %s" % model_type)
 
         # n_layer, n_head and n_embd are determined from model_type
@@ -227,16 +461,25 @@ class GPT(nn.Module):
         if 'dropout' in override_args:
             print(f"overriding dropout rate to {override_args['dropout']}")
             config_args['dropout'] = override_args['dropout']
-        # create a from-scratch initialized minGPT model
+        # create the minGPT model on the meta device, its weights are all coming from the checkpoint
         config = GPTConfig(**config_args)
-        model = GPT(config)
+        with torch.device('meta'):
+            model = GPT(config)
         sd = model.state_dict()
         sd_keys = sd.keys()
         sd_keys = [k for k in sd_keys if not k.endswith('.attn.bias')] # discard this mask / buffer, not a param
 
-        # init a huggingface/transformers model
-        model_hf = GPT2LMHeadModel.from_pretrained(model_type)
-        sd_hf = model_hf.state_dict()
+        if weights_path is None:
+            # init a huggingface/transformers model
+            from transformers import GPT2LMHeadModel
+            model_hf = GPT2LMHeadModel.from_pretrained(model_type)
+            sd_hf = model_hf.state_dict()
+        else:
+            print(f"streaming weights from {weights_path}")
+            sd_hf = LazyHFStateDict(weights_path)
+            if 'lm_head.weight' not in sd_hf:
+                # standalone checkpoints leave out lm_head, it is tied to wte anyway (see below)
+                sd_keys = [k for k in sd_keys if k != 'lm_head.weight']
 
         # copy while ensuring all of the parameters are aligned and match in names and shapes
         sd_keys_hf = sd_hf.keys()
@@ -246,21 +489,23 @@ class GPT(nn.Module):
         # basically the openai checkpoints use a "Conv1D" module, but we only want to use a vanilla Linear
         # this means that we have to transpose these weights when we import them
         assert len(sd_keys_hf) == len(sd_keys), f"mismatched keys: {len(sd_keys_hf)} != {len(sd_keys)}"
+        sd_new = {}
         for k in sd_keys_hf:
+            w_hf = sd_hf[k] # with a LazyHFStateDict, this is where the tensor gets read
             if any(k.endswith(w) for w in transposed):
                 # special treatment for the Conv1D weights we need to transpose
-                assert sd_hf[k].shape[::-1] == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k].t())
+                assert w_hf.shape[::-1] == sd[k].shape
+                sd_new[k] = w_hf.t().contiguous()
             else:
                 # vanilla copy over the other parameters
-                assert sd_hf[k].shape == sd[k].shape
-                with torch.no_grad():
-                    sd[k].copy_(sd_hf[k])
+                assert w_hf.shape == sd[k].shape
+                sd_new[k] = w_hf
+        sd_new.setdefault('lm_head.weight', sd_new['transformer.wte.weight'])
+        model._assign_state_dict(sd_new)
 
         return model
 
-    def configure_optimizers(self, weight_decay, learning_rate, betas, device_type):
+    def configure_optimizers(self, weight_decay, learning_rate, betas, device_type, zero=False):
         # start with all of the candidate parameters
         param_dict = {pn: p for pn, p in self.named_parameters()}
         # filter out those that do not require grad
@@ -281,8 +526,15 @@ class GPT(nn.Module):
         fused_available = 'fused' in inspect.signature(torch.optim.AdamW).parameters
         use_fused = fused_available and device_type == 'cuda'
         extra_args = dict(fused=True) if use_fused else dict()
-        optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=betas, **extra_args)
-        print(f"using fused AdamW: {use_fused}")
+        if zero:
+            # ZeRO stage 1: under torch.distributed every rank only keeps (and steps) the AdamW state of its
+            # own partition of the parameters, and broadcasts the updated parameters to the other ranks
+            from torch.distributed.optim import ZeroRedundancyOptimizer
+            optimizer = ZeroRedundancyOptimizer(optim_groups, optimizer_class=torch.optim.AdamW,
+                                                lr=learning_rate, betas=betas, **extra_args)
+        else:
+            optimizer = torch.optim.AdamW(optim_groups, lr=learning_rate, betas=betas, **extra_args)
+        print(f"using fused AdamW: {use_fused}, sharded across ranks (ZeRO-1): {zero}")
 
         return optimizer
 
@@ -302,29 +554,154 @@ class GPT(nn.Module):
         mfu = flops_achieved / flops_promised
         return mfu
 
+    @staticmethod
+    def logits_to_probs(logits, temperature=1.0, top_k=None):
+        """ the sampling distribution over the last dim of logits, after temperature and top_k """
+        # scale by desired temperature
+        logits = logits / temperature
+        # optionally crop the logits to only the top k options
+        if top_k is not None:
+            v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
+            logits[logits < v[..., [-1]]] = -float('Inf')
+        # apply softmax to convert logits to (normalized) probabilities
+        return F.softmax(logits, dim=-1)
+
     @torch.no_grad()
-    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None):
+    def generate(self, idx, max_new_tokens, temperature=1.0, top_k=None, use_kv_cache=True, prealloc_kv_cache=True,
+                 pad=None, generator=None, draft_model=None, num_draft_tokens=4, rolling_stride=0):
         """
         Take a conditioning sequence of indices idx (LongTensor of shape (b,t)) and complete
         the sequence max_new_tokens times, feeding the predictions back into the model each time.
         Most likely you'll want to make sure to be in model.eval() mode of operation for this.
+        With use_kv_cache=True only the newest token is pushed through the blocks at each step,
+        reusing the cached keys/values of the earlier positions; use_kv_cache=False recomputes
+        the full (cropped) context every step. prealloc_kv_cache picks between a cache allocated
+        once at block_size and one that grows with torch.cat.
+        Past block_size the cached keys/values can't simply be shifted, because the learned wpe
+        positions are baked into them. Instead the cache is re-encoded from a cropped window of
+        block_size - rolling_stride tokens whenever it fills up, and the next rolling_stride tokens
+        are decoded incrementally again. rolling_stride=0 re-encodes a full block_size window for
+        every token (exactly what the recompute path does); larger strides amortize one window
+        re-encode over rolling_stride + 1 tokens at the cost of a slightly shorter context.
+        Prompts of different lengths can be batched by left-padding them and passing the
+        number of pad tokens of every row in pad (LongTensor of shape (b,)). generator is either
+        a torch.Generator or a list with one per row, the latter making every row's sample
+        independent of the other rows in the batch.
+        Passing a (smaller) draft_model switches to speculative decoding, see generate_speculative.
         """
+        if draft_model is not None:
+            assert pad is None and not isinstance(generator, (list, tuple)), "speculative decoding is single-sequence only"
+            idx, _ = self.generate_speculative(idx, draft_model, max_new_tokens, num_draft_tokens, temperature, top_k,
+                                               prealloc_kv_cache=prealloc_kv_cache, generator=generator)
+            return idx
+        assert 0 <= rolling_stride < self.config.block_size
+        kv_cache = KVCache(self.config.n_layer, self.config.block_size, prealloc_kv_cache) if use_kv_cache else None
+        pad_cond = pad
         for _ in range(max_new_tokens):
-            # if the sequence context is growing too long we must crop it at block_size
-            idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -self.config.block_size:]
-            # forward the model to get the logits for the index in the sequence
-            logits, _ = self(idx_cond)
-            # pluck the logits at the final step and scale by desired temperature
-            logits = logits[:, -1, :] / temperature
-            # optionally crop the logits to only the top k options
-            if top_k is not None:
-                v, _ = torch.topk(logits, min(top_k, logits.size(-1)))
-                logits[logits < v[:, [-1]]] = -float('Inf')
-            # apply softmax to convert logits to (normalized) probabilities
-            probs = F.softmax(logits, dim=-1)
+            if kv_cache is not None and 0 < kv_cache.pos < self.config.block_size:
+                # the cache holds everything but the token we sampled last, so forward just that one
+                logits, _ = self(idx[:, [-1]], kv_cache=kv_cache, pad=pad_cond)
+            else:
+                # if the sequence context is growing too long we must crop it at block_size
+                # (or at the rolling window, leaving room for rolling_stride incremental steps)
+                window = self.config.block_size - rolling_stride if kv_cache is not None else self.config.block_size
+                idx_cond = idx if idx.size(1) <= self.config.block_size else idx[:, -window:]
+                if pad is not None:
+                    # cropping from the left eats into the padding first
+                    pad_cond = (pad - (idx.size(1) - idx_cond.size(1))).clamp(min=0)
+                if kv_cache is not None:
+                    # (re)fill the cache from scratch with the cropped context
+                    kv_cache.reset()
+                # forward the model to get the logits for the index in the sequence
+                logits, _ = self(idx_cond, kv_cache=kv_cache, pad=pad_cond)
+            # pluck the logits at the final step and convert them to (normalized) probabilities
+            probs = self.logits_to_probs(logits[:, -1, :], temperature, top_k)
             # sample from the distribution
-            idx_next = torch.multinomial(probs, num_samples=1)
+            if isinstance(generator, (list, tuple)):
+                idx_next = torch.cat([torch.multinomial(probs[[i]], num_samples=1, generator=g) for i, g in enumerate(generator)])
+            else:
+                idx_next = torch.multinomial(probs, num_samples=1, generator=generator)
             # append sampled index to the running sequence and continue
             idx = torch.cat((idx, idx_next), dim=1)
 
         return idx
+
+    @torch.no_grad()
+    def generate_speculative(self, idx, draft_model, max_new_tokens, num_draft_tokens=4, temperature=1.0, top_k=None,
+                             prealloc_kv_cache=True, generator=None):
+        """
+        Speculative decoding (https://arxiv.org/abs/2211.17192): every round the draft_model proposes
+        num_draft_tokens tokens autoregressively, then this (target) model scores all of them in a
+        single forward pass. Draft token d is accepted with probability min(1, p(d)/q(d)); on the first
+        rejection a replacement is drawn from norm(max(0, p - q)), and if all are accepted a bonus
+        token is drawn from p. The output follows exactly the target sampling distribution (with the
+        same temperature / top_k), it just needs fewer target forward passes.
+        Both models keep a KV cache that is rolled back over rejected tokens. Once the context no
+        longer fits in block_size it is cropped and the caches are refilled at the start of each round.
+        idx must be a single sequence (shape (1, t)). Returns idx and a dict of stats.
+        """
+        assert idx.size(0) == 1, "speculative decoding is single-sequence only"
+        k = num_draft_tokens
+        block_size = min(self.config.block_size, draft_model.config.block_size)
+        assert k < block_size
+        # the draft model may have a different (e.g. padded) vocab. its proposals are cut / zero-padded to
+        # our vocab and renormalized, which is still a valid proposal distribution as long as the same q is
+        # used for sampling and acceptance. tokens outside its vocab are clamped before being fed to it,
+        # that only costs proposal quality, never exactness
+        vocab_size = self.config.vocab_size
+        fit_vocab = lambda probs: F.pad(probs[..., :vocab_size], (0, max(vocab_size - probs.size(-1), 0)))
+        draft_max_token = draft_model.config.vocab_size - 1
+        target_cache = KVCache(self.config.n_layer, block_size, prealloc_kv_cache)
+        draft_cache = KVCache(draft_model.config.n_layer, block_size, prealloc_kv_cache)
+        t_start = idx.size(1)
+        rounds, drafted, accepted = 0, 0, 0
+        while idx.size(1) - t_start < max_new_tokens:
+            if idx.size(1) + k > block_size:
+                # crop the context so that the k draft tokens still fit, and refill both caches
+                idx_cond = idx[:, -(block_size - k):]
+                target_cache.reset()
+                draft_cache.reset()
+            else:
+                idx_cond = idx
+            n = idx_cond.size(1)
+            # 1) the draft model proposes k tokens, one at a time, feeding whatever its cache is missing
+            seq, qs = idx_cond, []
+            for _ in range(k):
+                logits, _ = draft_model(seq[:, draft_cache.pos:].clamp(max=draft_max_token), kv_cache=draft_cache)
+                q = fit_vocab(self.logits_to_probs(logits[:, -1, :], temperature, top_k))
+                q = q / q.sum(dim=-1, keepdim=True)
+                seq = torch.cat((seq, torch.multinomial(q, num_samples=1, generator=generator)), dim=1)
+                qs.append(q)
+            q = torch.cat(qs) # (k, vocab_size)
+            drafts = seq[0, n:] # (k,)
+            # 2) the target model scores the whole proposal in one forward pass. the last k+1 logits
+            # are the predictions for each of the k draft tokens and for the token following them
+            logits, _ = self(seq[:, target_cache.pos:], kv_cache=target_cache, all_logits=True)
+            p = self.logits_to_probs(logits[0, -(k + 1):, :], temperature, top_k) # (k + 1, vocab_size)
+            # 3) accept each draft token with probability min(1, p/q), up to the first rejection
+            p_d = p[:k].gather(-1, drafts[:, None]).squeeze(-1)
+            q_d = q.gather(-1, drafts[:, None]).squeeze(-1)
+            r = torch.rand(k, generator=generator, device=idx.device)
+            m = int((r * q_d < p_d).cumprod(0).sum().item()) # number of accepted draft tokens
+            if m < k:
+                # resample the rejected position from the residual distribution
+                residual = (p[m] - q[m]).clamp(min=0)
+                residual = residual / residual.sum() if residual.sum() > 0 else p[m]
+                idx_next = torch.multinomial(residual[None], num_samples=1, generator=generator)
+            else:
+                idx_next = torch.multinomial(p[[k]], num_samples=1, generator=generator)
+            idx = torch.cat((idx, drafts[None, :m], idx_next), dim=1)
+            # roll both caches back to the accepted prefix (the new token is fed next round)
+            target_cache.truncate(min(target_cache.pos, n + m))
+            draft_cache.truncate(min(draft_cache.pos, n + m))
+            rounds += 1
+            drafted += k
+            accepted += m
+
+        idx = idx[:, :t_start + max_new_tokens]
+        stats = dict(
+            rounds=rounds,
+            acceptance_rate=accepted / max(drafted, 1),
+            tokens_per_round=(idx.size(1) - t_start) / max(rounds, 1), # new tokens per target forward pass
+        )
+        return idx, stats
@@ -0,0 +1,157 @@
+"""
+Per-module profile of a GPT training step, from forward/backward hooks instead of a profiler trace:
+the time and activation memory of the embeddings, the ln_1 / attn / ln_2 / mlp of every Block, ln_f,
+lm_head and the loss, averaged over a number of steps. Used by bench.py --module_profile=True.
+
+Every hook synchronizes on cuda, so the profiled steps run slower than real ones, but the split
+between the modules holds. Activation memory is the growth of allocated memory over the module's
+forward on cuda (outputs plus whatever it saves for backward), the size of its outputs on CPU.
+Whatever the hooks can't attribute (e.g. the embedding weight gradients, computed after their
+backward hooks fired, or the residual adds between modules) ends up in 'other'.
+"""
+import json
+import time
+from collections import defaultdict
+
+import torch
+
+def profiled_modules(model):
+    """ (name, module) of the parts of a GPT that get profiled """
+    t = model.transformer
+    modules = [('wte', t.wte), ('wpe', t.wpe)]
+    for i, block in enumerate(t.h):
+        modules += [(f'h.{i}.{name}', child) for name, child in block.named_children()]
+    modules += [('ln_f', t.ln_f), ('lm_head', model.lm_head)]
+    return modules
+
+def tensor_bytes(output):
+    if torch.is_tensor(output):
+        return output.numel() * output.element_size()
+    if isinstance(output, (list, tuple)):
+        return sum(tensor_bytes(o) for o in output)
+    return 0
+
+class ModuleProfiler:
+
+    def __init__(self, model, cuda=False):
+        self.cuda = cuda
+        self.stats = defaultdict(lambda: defaultdict(float)) # module name -> forward_ms, backward_ms, activation_bytes, calls
+        self.totals = defaultdict(float) # forward_ms, backward_ms of the whole steps
+        self.steps = 0
+        self.forward_start, self.backward_start = {}, {}
+        self.last_forward_end = None # the loss is computed between the last module and the end of GPT.forward
+        self.loss_backward_start = None # set by start_backward, until the first module backward begins
+        self.handles = []
+        for name, module in profiled_modules(model):
+            self.handles += [
+                module.register_forward_pre_hook(self._forward_pre_hook(name)),
+                module.register_forward_hook(self._forward_hook(name)),
+                module.register_full_backward_pre_hook(self._backward_pre_hook(name)),
+                module.register_full_backward_hook(self._backward_hook(name)),
+            ]
+        self.handles.append(model.register_forward_hook(self._loss_forward_hook))
+
+    def now(self):
+        if self.cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _forward_pre_hook(self, name):
+        def hook(module, args):
+            memory = torch.cuda.memory_allocated() if self.cuda else 0
+            self.forward_start[name] = (self.now(), memory)
+        return hook
+
+    def _forward_hook(self, name):
+        def hook(module, args, output):
+            t, memory = self.forward_start.pop(name)
+            self.last_forward_end = self.now()
+            stats = self.stats[name]
+            stats['forward_ms'] += (self.last_forward_end - t) * 1000
+            stats['activation_bytes'] += torch.cuda.memory_allocated() - memory if self.cuda else tensor_bytes(output)
+            stats['calls'] += 1
+        return hook
+
+    def _loss_forward_hook(self, module, args, output):
+        stats = self.stats['loss']
+        stats['forward_ms'] += (self.now() - self.last_forward_end) * 1000
+        stats['calls'] += 1
+
+    def _backward_pre_hook(self, name):
+        def hook(module, grad_output):
+            t = self.now()
+            if self.loss_backward_start is not None:
+                # the first module to get its output gradient, everything before it was the loss
+                self.stats['loss']['backward_ms'] += (t - self.loss_backward_start) * 1000
+                self.loss_backward_start = None
+            self.backward_start[name] = t
+        return hook
+
+    def _backward_hook(self, name):
+        def hook(module, grad_input, grad_output):
+            self.stats[name]['backward_ms'] += (self.now() - self.backward_start.pop(name)) * 1000
+        return hook
+
+    def start_backward(self):
+        self.loss_backward_start = self.now()
+        return self.loss_backward_start
+
+    def step(self, forward_ms, backward_ms):
+        # the wall time of the whole forward and backward of this step, for the share of every module
+        self.totals['forward_ms'] += forward_ms
+        self.totals['backward_ms'] += backward_ms
+        self.steps += 1
+
+    def remove(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def results(self):
+        """ per step averages per module, per kind of module (summed over all Blocks) and in total """
+        n = max(self.steps, 1)
+        modules = {}
+        for name, stats in self.stats.items():
+            modules[name] = {
+                'forward_ms': stats['forward_ms'] / n,
+                'backward_ms': stats['backward_ms'] / n,
+                'activation_mib': stats['activation_bytes'] / n / 2**20,
+                'calls': stats['calls'] / n,
+            }
+        total_forward, total_backward = self.totals['forward_ms'] / n, self.totals['backward_ms'] / n
+        modules['other'] = {
+            'forward_ms': total_forward - sum(m['forward_ms'] for m in modules.values()),
+            'backward_ms': total_backward - sum(m['backward_ms'] for m in modules.values()),
+            'activation_mib': 0.0,
+            'calls': 0.0,
+        }
+        by_kind = defaultdict(lambda: defaultdict(float))
+        for name, m in modules.items():
+            kind = name.split('.')[-1] # h.3.attn -> attn
+            for k, v in m.items():
+                by_kind[kind][k] += v
+        for m in list(modules.values()) + list(by_kind.values()):
+            m['total_ms'] = m['forward_ms'] + m['backward_ms']
+        return {
+            'steps': self.steps,
+            'forward_ms': total_forward,
+            'backward_ms': total_backward,
+            'modules': modules,
+            'by_kind': {k: dict(v) for k, v in by_kind.items()},
+        }
+
+    def print_table(self, json_path=None):
+        results = self.results()
+        step_ms = results['forward_ms'] + results['backward_ms']
+        for title, rows in [('module', results['modules']), ('kind (all Blocks)', results['by_kind'])]:
+            print(f"{title:>20s} {'fwd ms':>9s} {'bwd ms':>9s} {'total ms':>9s} {'share':>7s} {'act MiB':>9s}")
+            for name, m in sorted(rows.items(), key=lambda kv: -kv[1]['total_ms']):
+                print(f"{name:>20s} {m['forward_ms']:9.3f} {m['backward_ms']:9.3f} {m['total_ms']:9.3f} "
+                      f"{m['total_ms'] / step_ms * 100:6.2f}% {m['activation_mib']:9.2f}")
+            print()
+        print(f"per step over {results['steps']} steps: forward {results['forward_ms']:.3f}ms, backward {results['backward_ms']:.3f}ms")
+        if json_path:
+            with open(json_path, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f"wrote {json_path}")
+        return results
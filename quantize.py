@@ -0,0 +1,177 @@
+"""
+Int8 weight-only quantization of a GPT, for CPU inference where the memory bandwidth of
+streaming the fp32 c_attn / c_fc / c_proj / lm_head weights dominates latency.
+
+Every nn.Linear is swapped for an Int8Linear that stores int8 weights with one fp scale
+per output channel (symmetric, absmax / 127). Activations stay in float. On CPU the matmul is
+PyTorch's int8 weight-only kernel (aten._weight_int8pack_mm), which reads the int8 weights
+directly and applies the scales itself. Elsewhere, or on a PyTorch without it, the weight is
+dequantized on the fly, which saves memory but no bandwidth over the float model.
+Note that this unties lm_head from wte: the token embedding stays in float.
+
+Quantize a checkpoint and compare the val.bin perplexity and the decoding latency against fp32:
+$ python quantize.py --out_dir=out-shakespeare-char
+$ python quantize.py --init_from=gpt2 --dataset=openwebtext
+which writes ckpt_int8.pt into out_dir, loadable with
+$ python sample.py --out_dir=out-shakespeare-char --init_from=ckpt_int8.pt --device=cpu
+"""
+import os
+from dataclasses import asdict
+
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+from model import GPTConfig, GPT
+
+try:
+    _weight_int8pack_mm = torch.ops.aten._weight_int8pack_mm
+except (AttributeError, RuntimeError): # older PyTorch
+    _weight_int8pack_mm = None
+
+class Int8Linear(nn.Module):
+    """ nn.Linear with int8 weights and a per-output-channel scale, for inference only """
+
+    def __init__(self, in_features, out_features, bias=True):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight", torch.zeros(out_features, in_features, dtype=torch.int8))
+        self.register_buffer("scale", torch.ones(out_features))
+        self.register_buffer("bias", torch.zeros(out_features) if bias else None)
+
+    @classmethod
+    @torch.no_grad()
+    def from_linear(cls, linear):
+        q = cls(linear.in_features, linear.out_features, bias=linear.bias is not None).to(linear.weight.device)
+        w = linear.weight.float()
+        scale = w.abs().amax(dim=1).clamp(min=1e-8) / 127.0
+        q.weight.copy_(torch.round(w / scale[:, None]).clamp(-127, 127).to(torch.int8))
+        q.scale.copy_(scale)
+        if linear.bias is not None:
+            q.bias.copy_(linear.bias)
+        return q
+
+    def forward(self, x):
+        if _weight_int8pack_mm is not None and x.device.type == 'cpu' and x.dtype in (torch.float32, torch.bfloat16):
+            # (M, K) float activations @ (N, K) int8 weights, scaled per output channel inside the kernel
+            y = _weight_int8pack_mm(x.reshape(-1, self.in_features).contiguous(), self.weight, self.scale.to(x.dtype))
+            y = y.view(*x.shape[:-1], self.out_features)
+        else:
+            y = F.linear(x, self.weight.to(x.dtype))
+            y = y * self.scale.to(y.dtype)
+        if self.bias is not None:
+            y = y + self.bias.to(y.dtype)
+        return y
+
+def quantize_model(model, from_weights=True):
+    """
+    Swap every nn.Linear of model for an Int8Linear, in place. With from_weights=False only the
+    module structure is converted (e.g. right before loading a quantized state_dict).
+    """
+    # the chunked loss reads lm_head.weight directly, which is now int8 without its scale
+    model.config.loss_chunk_size = 0
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, nn.Linear):
+                if from_weights:
+                    q = Int8Linear.from_linear(child)
+                else:
+                    q = Int8Linear(child.in_features, child.out_features, bias=child.bias is not None)
+                setattr(module, child_name, q)
+    return model
+
+def save_quantized(model, path, **extra):
+    checkpoint = {
+        'model': model.state_dict(),
+        'model_args': asdict(model.config),
+        'quantization': 'int8',
+        **extra,
+    }
+    torch.save(checkpoint, path)
+
+def load_quantized(checkpoint):
+    """ build a quantized GPT from a checkpoint dict written by save_quantized """
+    assert checkpoint.get('quantization') == 'int8', "not an int8 checkpoint"
+    model = quantize_model(GPT(GPTConfig(**checkpoint['model_args'])), from_weights=False)
+    model.load_state_dict(checkpoint['model'])
+    return model
+
+if __name__ == '__main__':
+    import math
+    import time
+    from dataloader import contiguous_windows
+
+    # -----------------------------------------------------------------------------
+    init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
+    out_dir = 'out' # the int8 checkpoint is written here as ckpt_int8.pt
+    dataset = '' # defaults to the dataset the checkpoint was trained on
+    batch_size = 8
+    eval_iters = 50 # number of (batch_size, block_size) windows of val.bin to measure perplexity on
+    latency_tokens = 64 # number of tokens to generate (batch size 1) when timing the decoding latency, 0 = skip
+    device = 'cpu'
+    exec(open('configurator.py').read()) # overrides from command line or config file
+    # -----------------------------------------------------------------------------
+
+    if init_from == 'resume':
+        checkpoint = torch.load(os.path.join(out_dir, 'ckpt.pt'), map_location=device)
+        model = GPT(GPTConfig(**checkpoint['model_args']))
+        state_dict = checkpoint['model']
+        unwanted_prefix = '_orig_mod.'
+        for k,v in list(state_dict.items()):
+            if k.startswith(unwanted_prefix):
+                state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
+        model.load_state_dict(state_dict)
+        dataset = dataset or checkpoint.get('config', {}).get('dataset', '')
+        checkpoint = None # free up memory
+    else:
+        model = GPT.from_pretrained(init_from, dict(dropout=0.0))
+    assert dataset, "set --dataset to measure perplexity on"
+    model.eval()
+    model.to(device)
+
+    # contiguous, non-overlapping windows from the start of val.bin, so both models see the same tokens
+    data_dir = dataset if os.path.isabs(dataset) else os.path.join('data', dataset)
+    X, Y = contiguous_windows(os.path.join(data_dir, 'val.bin'), model.config.block_size, max_windows=batch_size * eval_iters)
+    num_windows, block_size = X.size()
+
+    @torch.no_grad()
+    def perplexity(model):
+        losses = []
+        for i in range(0, num_windows, batch_size):
+            x, y = X[i:i+batch_size].to(device), Y[i:i+batch_size].to(device)
+            _, loss = model(x, y)
+            losses.append(loss.item() * x.size(0))
+        return math.exp(sum(losses) / num_windows)
+
+    @torch.no_grad()
+    def latency(model):
+        # ms per generated token at batch size 1, the bandwidth-bound case quantization is meant for
+        prompt = X[:1, :16].to(device)
+        model.generate(prompt, 8, top_k=1) # warmup
+        if 'cuda' in device:
+            torch.cuda.synchronize()
+        t0 = time.time()
+        model.generate(prompt, latency_tokens, top_k=1)
+        if 'cuda' in device:
+            torch.cuda.synchronize()
+        return (time.time() - t0) / latency_tokens * 1000
+
+    ppl_fp32 = perplexity(model)
+    print(f"fp32 val perplexity: {ppl_fp32:.4f} ({num_windows * block_size:,} tokens)")
+    ms_fp32 = latency(model) if latency_tokens > 0 else None
+    if ms_fp32 is not None:
+        print(f"fp32 latency: {ms_fp32:.2f}ms per token")
+    quantize_model(model)
+    ppl_int8 = perplexity(model)
+    print(f"int8 val perplexity: {ppl_int8:.4f} ({(ppl_int8 / ppl_fp32 - 1) * 100:+.2f}% vs fp32)")
+    ms_int8 = latency(model) if latency_tokens > 0 else None
+    if ms_int8 is not None:
+        kernel = 'int8 kernel' if _weight_int8pack_mm is not None and device == 'cpu' else 'dequantized on the fly'
+        print(f"int8 latency: {ms_int8:.2f}ms per token ({ms_fp32 / ms_int8:.2f}x vs fp32, {kernel})")
+
+    os.makedirs(out_dir, exist_ok=True)
+    ckpt_path = os.path.join(out_dir, 'ckpt_int8.pt')
+    save_quantized(model, ckpt_path, config={'dataset': dataset}, ppl_fp32=ppl_fp32, ppl_int8=ppl_int8,
+                   ms_fp32=ms_fp32, ms_int8=ms_int8)
+    print(f"saved int8 checkpoint to {ckpt_path}")
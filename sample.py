@@ -2,15 +2,19 @@
 Sample from a trained model
 """
 import os
+import time
 import pickle
+import resource
 from contextlib import nullcontext
 import torch
 import tiktoken
 from model import GPTConfig, GPT
+from quantize import quantize_model, load_quantized
 
 # -----------------------------------------------------------------------------
 init_from = 'resume' # either 'resume' (from an out_dir) or a gpt2 variant (e.g. 'gpt2-xl')
 out_dir = 'out' # ignored if init_from is not 'resume'
+pretrained_weights = '' # with a gpt2 variant: local model.safetensors / pytorch_model.bin to stream the weights from, instead of transformers
 start = "\n" # or "<|endoftext|>" or etc. Can also specify a file, use as: "FILE:prompt.txt"
 num_samples = 10 # number of samples to draw
 max_new_tokens = 150 # number of tokens generated in each sample
@@ -20,6 +24,16 @@ seed = 1337
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1', etc.
 dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32' or 'bfloat16' or 'float16'
 compile = False # use PyTorch 2.0 to compile the model to be faster
+meta_init = True # build the model on the meta device and take its weights straight from the checkpoint, skipping the random init
+use_kv_cache = True # only forward the newest token each step, reusing cached keys/values. False = recompute the full context
+prealloc_kv_cache = True # allocate the KV cache once at block_size instead of growing it with torch.cat
+quantize = False # int8 weight-only quantize the model's Linears after loading, meant for CPU inference
+rolling_stride = 0 # past block_size, re-encode the KV cache only every rolling_stride + 1 tokens (0 = every token)
+batched = False # draw all samples in a single generate call instead of one call per sample
+starts = [] # batched mode only: several prompts of different lengths, num_samples are drawn for each, e.g. --starts="['Hi','Once upon a time']"
+draft_model = '' # speculative decoding with a small draft model: a gpt2 variant (e.g. 'gpt2') or a path to a checkpoint .pt file
+num_draft_tokens = 4 # number of tokens the draft model proposes per round
+draft_baseline = True # also time plain generation once, to report the wall-clock speedup of speculative decoding
 exec(open('configurator.py').read()) # overrides from command line or config file
 # -----------------------------------------------------------------------------
 
@@ -32,21 +46,12 @@ ptdtype = {'float32': torch.float32, 'bfloat16': torch.bfloat16, 'float16': torc
 ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=device_type, dtype=ptdtype)
 
 # model
-model = None
-if init_from.endswith('.pt'):
-    # init from a specific checkpoint file
-    ckpt_path = os.path.join(out_dir, init_from)
-elif init_from == 'resume':
-    # init from the default 'ckpt.pt' in out_dir
-    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
-elif init_from.startswith('gpt2'):
-    # init from a given GPT-2 model
-    print(f"Initializing from OpenAI GPT-2 weights: {init_from}")
-    model = GPT.from_pretrained(init_from, dict(dropout=0.0))
-else:
-    raise ValueError(f"Invalid init_from: {init_from}")
-
-if model is None: # If not a gpt2 pretrained model, then it's a checkpoint
+def load_model(init_from, ckpt_path=None, weights_path=None):
+    # returns the model and, if it came from one of our checkpoints, the checkpoint dict
+    if init_from.startswith('gpt2'):
+        # init from a given GPT-2 model
+        print(f"Initializing from OpenAI GPT-2 weights: {init_from}")
+        return GPT.from_pretrained(init_from, dict(dropout=0.0), weights_path=weights_path), None
     print(f"Loading checkpoint from {ckpt_path}")
     checkpoint = torch.load(ckpt_path, map_location=device)
     if 'iter_num' in checkpoint:
@@ -57,23 +62,57 @@ if model is None: # If not a gpt2 pretrained model, then it's a checkpoint
         print("Training config:")
         for k, v in checkpoint['config'].items():
             print(f"  {k}: {v}")
+    if 'quantization' in checkpoint:
+        # written by quantize.py
+        print(f"Loading {checkpoint['quantization']} quantized weights")
+        return load_quantized(checkpoint), checkpoint
     gptconf = GPTConfig(**checkpoint['model_args'])
-    model = GPT(gptconf)
     state_dict = checkpoint['model']
     unwanted_prefix = '_orig_mod.'
     for k,v in list(state_dict.items()):
         if k.startswith(unwanted_prefix):
             state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
+    if meta_init:
+        model = GPT.from_state_dict(gptconf, state_dict)
+    else:
+        model = GPT(gptconf)
+        model.load_state_dict(state_dict)
+    return model, checkpoint
+
+ckpt_path = None
+if init_from.endswith('.pt'):
+    # init from a specific checkpoint file
+    ckpt_path = os.path.join(out_dir, init_from)
+elif init_from == 'resume':
+    # init from the default 'ckpt.pt' in out_dir
+    ckpt_path = os.path.join(out_dir, 'ckpt.pt')
+elif not init_from.startswith('gpt2'):
+    raise ValueError(f"Invalid init_from: {init_from}")
+t0 = time.time()
+model, checkpoint = load_model(init_from, ckpt_path, pretrained_weights or None)
+peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20 # ru_maxrss is in KiB on linux
+print(f"model ready in {time.time()-t0:.2f}s (meta_init={meta_init}), peak RSS so far {peak_rss:.2f}GiB")
+if quantize and 'quantization' not in (checkpoint or {}):
+    print("Quantizing Linear weights to int8")
+    quantize_model(model)
 
 model.eval()
 model.to(device)
 if compile:
     model = torch.compile(model) # requires PyTorch 2.0 (optional)
 
+# optional small draft model for speculative decoding, e.g. 'gpt2' or a path to one of our checkpoints
+draft = None
+if draft_model:
+    draft, _ = load_model(draft_model, draft_model)
+    draft.eval()
+    draft.to(device)
+    if compile:
+        draft = torch.compile(draft)
+
 # look for the meta pickle in case it is available in the dataset folder
 load_meta = False
-if init_from == 'resume' and 'config' in checkpoint and 'dataset' in checkpoint['config']: # older checkpoints might not have these...
+if checkpoint is not None and 'dataset' in checkpoint.get('config', {}): # any of our checkpoints, older ones might not have these...
     meta_path = os.path.join('data', checkpoint['config']['dataset'], 'meta.pkl')
     load_meta = os.path.exists(meta_path)
 if load_meta:
@@ -98,11 +137,67 @@ if start.startswith('FILE:'):
 start_ids = encode(start)
 x = (torch.tensor(start_ids, dtype=torch.long, device=device)[None, ...])
 
+def generate_batched(prompts):
+    # left-pad the prompts to a common length and let the per-row pad count drive the attention mask
+    rows = [encode(p) for p in prompts for _ in range(num_samples)]
+    width = max(len(r) for r in rows)
+    pad = torch.tensor([width - len(r) for r in rows], dtype=torch.long, device=device)
+    x = torch.tensor([[0] * (width - len(r)) + r for r in rows], dtype=torch.long, device=device)
+    # one generator per row, so that each row is reproducible no matter what else is in the batch
+    generators = [torch.Generator(device=device).manual_seed(seed + i) for i in range(len(rows))]
+    t0 = time.time()
+    y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k,
+                       use_kv_cache=use_kv_cache, prealloc_kv_cache=prealloc_kv_cache,
+                       pad=pad, generator=generators, rolling_stride=rolling_stride)
+    if device_type == 'cuda':
+        torch.cuda.synchronize()
+    dt = time.time() - t0
+    for i in range(len(rows)):
+        print(decode(y[i, pad[i].item():].tolist()))
+        print('---------------')
+    print(f"generated {len(rows)} x {max_new_tokens} tokens in {dt:.2f}s ({len(rows) * max_new_tokens / dt:.2f} tokens/sec)")
+
+def generate_speculative():
+    baseline_tps = None
+    if draft_baseline:
+        t0 = time.time()
+        model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k, prealloc_kv_cache=prealloc_kv_cache)
+        if device_type == 'cuda':
+            torch.cuda.synchronize()
+        baseline_tps = max_new_tokens / (time.time() - t0)
+        print(f"baseline (no draft model): {baseline_tps:.2f} tokens/sec")
+        print('---------------')
+    for k in range(num_samples):
+        t0 = time.time()
+        y, stats = model.generate_speculative(x, draft, max_new_tokens, num_draft_tokens, temperature, top_k,
+                                              prealloc_kv_cache=prealloc_kv_cache)
+        if device_type == 'cuda':
+            torch.cuda.synchronize()
+        tps = max_new_tokens / (time.time() - t0)
+        print(decode(y[0].tolist()))
+        print_str = f"({tps:.2f} tokens/sec, acceptance rate {stats['acceptance_rate']*100:.1f}%, {stats['tokens_per_round']:.2f} tokens per target forward"
+        if baseline_tps is not None:
+            print_str += f", speedup {tps / baseline_tps:.2f}x"
+        print(print_str + ")")
+        print('---------------')
+
 print('---------------')
 # run generation
 with torch.no_grad():
     with ctx:
-        for k in range(num_samples):
-            y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k)
-            print(decode(y[0].tolist()))
-            print('---------------')
+        if batched:
+            generate_batched(starts if starts else [start])
+        elif draft is not None:
+            generate_speculative()
+        else:
+            for k in range(num_samples):
+                t0 = time.time()
+                y = model.generate(x, max_new_tokens, temperature=temperature, top_k=top_k,
+                                   use_kv_cache=use_kv_cache, prealloc_kv_cache=prealloc_kv_cache,
+                                   rolling_stride=rolling_stride)
+                if device_type == 'cuda':
+                    torch.cuda.synchronize()
+                dt = time.time() - t0
+                print(decode(y[0].tolist()))
+                print(f"({max_new_tokens / dt:.2f} tokens/sec, kv cache: {use_kv_cache})")
+                print('---------------')
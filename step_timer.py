@@ -0,0 +1,94 @@
+"""
+Optional per-phase timing of the training step, to see where the time of a train.py iteration
+goes: waiting on data, forward, backward, the gradient all-reduce, gradient clipping and the
+optimizer step.
+
+Device work is timed with CUDA events (the host only queues it, so a host clock would measure
+nothing useful), host-side waits like the data loader with a monotonic clock. Finishing a step
+synchronizes once to read the events, then appends one JSON record per step to a file and keeps
+the last window steps per phase in memory for a p50/p95 summary. When disabled, phase() hands out
+a shared nullcontext and step() returns right away.
+
+Under DDP the all-reduce overlaps the backward pass of the last micro step, so it is not a phase
+of its own: that backward is timed as 'backward_sync', and what it takes more than an average
+micro step backward is reported as 'allreduce_exposed'. The micro step backward of the most recent
+step that had one is the baseline. With gradient_accumulation_steps=1 every backward syncs and
+there is none, allreduce_exposed is then reported as unavailable.
+"""
+import json
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager, nullcontext
+
+import torch
+
+_disabled = nullcontext()
+
+class StepTimer:
+
+    def __init__(self, enabled=False, cuda=False, path=None, window=100):
+        self.enabled = enabled
+        self.cuda = cuda
+        self.history = defaultdict(lambda: deque(maxlen=window)) # ring buffer of ms per step, per phase
+        self.pending = [] # (phase, start, end) of the current step
+        self.backward_baseline = None # ms of the last micro step backward without the all-reduce
+        self.file = open(path, 'a', buffering=1) if enabled and path else None # line buffered, readable while training
+
+    def phase(self, name, host=False):
+        """ context manager timing one occurrence of phase name, host=True for host-side waits """
+        if not self.enabled:
+            return _disabled
+        return self._phase(name, host)
+
+    @contextmanager
+    def _phase(self, name, host):
+        if self.cuda and not host:
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+        else:
+            start = time.perf_counter()
+            yield
+            end = time.perf_counter()
+        self.pending.append((name, start, end))
+
+    def step(self, iter_num):
+        """ close the current step: resolve its phase times (ms, summed over micro steps) and record them """
+        if not self.enabled:
+            return
+        if self.cuda:
+            torch.cuda.synchronize()
+        times, counts = defaultdict(float), defaultdict(int)
+        for name, start, end in self.pending:
+            times[name] += start.elapsed_time(end) if isinstance(start, torch.cuda.Event) else (end - start) * 1000
+            counts[name] += 1
+        self.pending = []
+        if counts['backward'] > 0:
+            self.backward_baseline = times['backward'] / counts['backward']
+        if 'backward_sync' in times and self.backward_baseline is not None:
+            times['allreduce_exposed'] = max(0.0, times['backward_sync'] - self.backward_baseline)
+        for name, ms in times.items():
+            self.history[name].append(ms)
+        if self.file is not None:
+            self.file.write(json.dumps({'iter': iter_num, **{k: round(v, 3) for k, v in times.items()}}) + "\n")
+
+    def summary(self):
+        """ p50 / p95 in ms of every phase over the last window steps """
+        out = {}
+        for name, values in self.history.items():
+            values = sorted(values)
+            out[name] = {'p50': values[len(values) // 2], 'p95': values[min(len(values) - 1, int(len(values) * 0.95))]}
+        return out
+
+    def format_summary(self):
+        summary = self.summary()
+        out = ", ".join(f"{name} {s['p50']:.2f}/{s['p95']:.2f}ms" for name, s in summary.items())
+        if 'backward_sync' in summary and 'allreduce_exposed' not in summary:
+            out += ", allreduce_exposed n/a (no backward without sync to compare against)"
+        return out
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
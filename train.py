@@ -14,12 +14,17 @@ $ torchrun --nproc_per_node=8 --nnodes=2 --node_rank=0 --master_addr=123.456.123
 - Run on the worker node:
 $ torchrun --nproc_per_node=8 --nnodes=2 --node_rank=1 --master_addr=123.456.123.456 --master_port=1234 train.py
 (If your cluster does not have Infiniband interconnect prepend NCCL_IB_DISABLE=1)
+
+To run with DDP on the cores of a CPU box, 4 ranks each pinned to its own quarter of the cores
+(B * T * ranks has to divide total_batch_size, 16 * 256 * 4 = 16384 here):
+$ torchrun --standalone --nproc_per_node=4 train.py config/train_shakespeare_char.py --device=cpu --backend=gloo --compile=False --B=16
 """
 
 import os
 import time
 import math
 import pickle
+import resource
 from contextlib import nullcontext
 
 import numpy as np
@@ -29,6 +34,10 @@ from torch.distributed import init_process_group, destroy_process_group
 
 from model import GPTConfig, GPT
 from debug import Debug
+from dataloader import BatchLoader, EpochSampler, contiguous_windows
+from checkpointer import AsyncCheckpointer, load_checkpoint
+from comm_hooks import register_comm_hook, LossLog
+from step_timer import StepTimer
 
 # -----------------------------------------------------------------------------
 # default config values designed to train a gpt2 (124M) on OpenWebText
@@ -37,9 +46,19 @@ out_dir = 'out'
 eval_interval = 2000
 log_interval = 1
 eval_iters = 200
+val_mode = 'random' # 'random': eval_iters random batches of val.bin. 'sweep': all of val.bin in non-overlapping windows, deterministic
+val_batch_size = 32 # with val_mode='sweep', windows per (no-grad) forward pass
+val_cache = True # with val_mode='sweep', keep the val windows in (device) memory across evals
 eval_only = False # if True, script exits right after the first eval
+eval_inline = True # if False, only write a checkpoint every eval_interval and leave the evaluation to evaluator.py, running alongside
 always_save_checkpoint = True # if True, always save a checkpoint after each eval
+async_checkpoint = True # write checkpoints from a background thread, training only waits for the copy to CPU memory
+snapshot_iters = (10, 250, 1000) # iterations at which an extra ckpt_{iter}.pt is kept for good (checked at eval time), e.g. --snapshot_iters=500,2000 or --snapshot_iters=500, for one
+snapshot_interval = 0 # > 0: also write a ckpt_{iter}.pt at every multiple of this many iterations (checked at eval time)
+keep_last_snapshots = 0 # > 0: of the snapshot_interval snapshots only keep the most recent ones
 init_from = 'scratch' # 'scratch' or 'resume' or 'gpt2*'
+ckpt_broadcast = True # DDP: rank 0 reads the checkpoint (mmap'd) and broadcasts it, instead of every rank reading the whole file
+pretrained_weights = '' # with init_from='gpt2*': local model.safetensors / pytorch_model.bin to stream the weights from, instead of transformers
 # wandb logging
 wandb_log = False # disabled by default
 wandb_project = 'owt'
@@ -49,12 +68,19 @@ dataset = 'openwebtext'
 total_batch_size = 524288 # 2**19, ~0.5M, in number of tokens
 B = 12 # micro-batch size
 T = 1024 # sequence length
+data_prefetch = 4 # batches a background thread keeps ready ahead of the training loop, 0 = load them synchronously
+data_sampler = 'epoch' # 'epoch': a seeded permutation of non-overlapping windows per epoch, resumable. 'random': random offsets
+data_sort_offsets = False # read the windows of a batch in file order, for page-cache locality on large datasets
 # model
 n_layer = 12
 n_head = 12
+n_kv_head = 0 # grouped-query attention: number of key/value heads, 0 = n_head (plain multi-head attention)
 n_embd = 768
 dropout = 0.0 # for pretraining 0 is good, for finetuning try 0.1+
 bias = False # do we use bias inside LayerNorm and Linear layers?
+loss_chunk_size = 0 # > 0: chunked cross-entropy that never materializes the full (B, T, vocab_size) logits, allows a larger B
+recompute = 'none' # activation recomputation, trades compute for memory: 'none', 'all', 'every_n' or 'attn'
+recompute_every_n = 2 # with recompute='every_n', recompute every n-th block
 # adamw optimizer
 learning_rate = 6e-4 # max learning rate
 max_iters = 600000 # total number of training iterations
@@ -62,6 +88,7 @@ weight_decay = 1e-1
 beta1 = 0.9
 beta2 = 0.95
 grad_clip = 1.0 # clip gradients at this value, or disable if == 0.0
+zero_optimizer = False # DDP: shard the AdamW state across ranks (ZeRO-1), each rank then checkpoints its own ckpt_optim{rank}.pt
 # learning rate decay settings
 decay_lr = True # whether to decay the learning rate
 warmup_iters = 2000 # how many steps to warm up for
@@ -69,16 +96,27 @@ lr_decay_iters = 600000 # should be ~= max_iters per Chinchilla
 min_lr = 6e-5 # minimum learning rate, should be ~= learning_rate/10 per Chinchilla
 # DDP settings
 backend = 'nccl' # 'nccl', 'gloo', etc.
+cpu_threads_per_rank = 0 # CPU DDP (device='cpu', backend='gloo'): cores pinned to each rank, 0 = split this node's cores evenly. without DDP: intra-op threads
+ddp_comm_hook = 'none' # compression of the gradient all-reduce: 'none', 'fp16', 'bf16' or 'powersgd', see comm_hooks.py
+powersgd_rank = 4 # with ddp_comm_hook='powersgd', rank of the low-rank gradient approximation
+powersgd_start_iter = 1000 # with ddp_comm_hook='powersgd', plain all-reduce steps before compression kicks in
+loss_log = False # append the train/val losses to out_dir/loss.jsonl, e.g. of a ddp_comm_hook='none' run to compare compressed runs against
+loss_reference = '' # loss.jsonl of a reference run of the same config and seed: report the loss gap of this run to it at the same iterations
+scaling_baseline = 0.0 # tok/sec (a float) of a single-process run of the same config with as many threads as one rank, DDP runs then report their scaling efficiency against it
 # system
 device = 'cuda' # examples: 'cpu', 'cuda', 'cuda:0', 'cuda:1' etc., or try 'mps' on macbooks
 dtype = 'bfloat16' if torch.cuda.is_available() and torch.cuda.is_bf16_supported() else 'float16' # 'float32', 'bfloat16', or 'float16', the latter will auto implement a GradScaler
 compile = True # use PyTorch 2.0 to compile the model to be faster
+meta_init = True # build the model on the meta device when its weights come from a checkpoint, skipping the random init
+time_phases = False # time data wait / forward / backward / all-reduce / clip / optimizer of every step, one JSON line each to out_dir/step_times.jsonl (syncs once per step)
+time_phases_window = 100 # number of recent steps the p50/p95 phase summary is taken over
 # debug
 debug_batches = False
 # -----------------------------------------------------------------------------
 config_keys = [k for k,v in globals().items() if not k.startswith('_') and isinstance(v, (int, float, bool, str))]
 exec(open('configurator.py').read()) # overrides from command line or config file
 config = {k: globals()[k] for k in config_keys} # will be useful for logging
+config['snapshot_iters'] = snapshot_iters # a tuple, not picked up by config_keys
 # -----------------------------------------------------------------------------
 
 # various inits, derived attributes, I/O setup
@@ -88,8 +126,21 @@ if ddp:
     ddp_rank = int(os.environ['RANK'])
     ddp_local_rank = int(os.environ['LOCAL_RANK'])
     ddp_world_size = int(os.environ['WORLD_SIZE'])
-    device = f'cuda:{ddp_local_rank}'
-    torch.cuda.set_device(device)
+    if 'cuda' in device:
+        device = f'cuda:{ddp_local_rank}'
+        torch.cuda.set_device(device)
+    else:
+        # CPU DDP: every rank on this node gets its own disjoint set of cores, and as many intra-op threads,
+        # so that the ranks don't oversubscribe the cores and fight over them
+        assert backend == 'gloo', "DDP on CPU needs backend='gloo'"
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', ddp_world_size))
+        cores = sorted(os.sched_getaffinity(0))
+        threads = cpu_threads_per_rank or len(cores) // local_world_size
+        assert 0 < threads * local_world_size <= len(cores), f"{local_world_size} ranks x {threads} threads don't fit on {len(cores)} cores"
+        rank_cores = cores[ddp_local_rank * threads:(ddp_local_rank + 1) * threads]
+        os.sched_setaffinity(0, rank_cores)
+        torch.set_num_threads(threads)
+        print(f"rank {ddp_rank}: pinned to cores {rank_cores}, {threads} threads")
     master_process = ddp_rank == 0 # this process will do logging, checkpointing etc.
     seed_offset = ddp_rank # each process gets a different seed
     # world_size number of processes will be training simultaneously, so we can scale
@@ -99,7 +150,10 @@ else:
     # if not ddp, we are running on a single gpu, and one process
     master_process = True
     seed_offset = 0
+    ddp_rank = 0
     ddp_world_size = 1
+    if cpu_threads_per_rank > 0 and 'cuda' not in device:
+        torch.set_num_threads(cpu_threads_per_rank) # e.g. the single-rank baseline for scaling_baseline
 tokens_per_iter = total_batch_size
 if master_process:
     print(f"tokens per iteration will be: {tokens_per_iter:,}")
@@ -123,22 +177,40 @@ ctx = nullcontext() if device_type == 'cpu' else torch.amp.autocast(device_type=
 # poor man's data loader
 data_dir = dataset if os.path.isabs(dataset) else os.path.join('data', dataset)
 
-def get_batch(split):
-    # We recreate np.memmap every batch to avoid a memory leak, as per
-    # https://stackoverflow.com/questions/45132940/numpy-memmap-memory-usage-want-to-iterate-once/61472122#61472122
-    if split == 'train':
-        data = np.memmap(os.path.join(data_dir, 'train.bin'), dtype=np.uint16, mode='r')
-    else:
-        data = np.memmap(os.path.join(data_dir, 'val.bin'), dtype=np.uint16, mode='r')
-    ix = torch.randint(len(data) - T, (B,))
-    x = torch.stack([torch.from_numpy((data[i:i+T]).astype(np.int64)) for i in ix])
-    y = torch.stack([torch.from_numpy((data[i+1:i+1+T]).astype(np.int64)) for i in ix])
-    if device_type == 'cuda':
-        # pin arrays x,y, which allows us to move them to GPU asynchronously (non_blocking=True)
-        x, y = x.pin_memory().to(device, non_blocking=True), y.pin_memory().to(device, non_blocking=True)
-    else:
-        x, y = x.to(device), y.to(device)
-    return x, y, ix
+loaders = {} # created on first use, T may still change when resuming from a checkpoint
+sampler_state = None # position of the train data sampler, restored from the checkpoint on resume
+def get_batch(split, for_eval=False):
+    # the train batches of an eval come from a loader of their own, with random offsets: drawing them from
+    # the training loader would skip windows of its epoch and move its sampler state past the pending batch
+    key = 'train_eval' if split == 'train' and for_eval else split
+    if key not in loaders:
+        path = os.path.join(data_dir, 'train.bin' if split == 'train' else 'val.bin')
+        seed = 1337 + seed_offset + {'train': 0, 'val': 1000, 'train_eval': 2000}[key]
+        sampler = None
+        if key == 'train' and data_sampler == 'epoch':
+            # same seed on every rank: they all walk the same permutation, each taking its own slice of every step
+            n_tokens = len(np.memmap(path, dtype=np.uint16, mode='r'))
+            sampler = EpochSampler(n_tokens, B, T, rank=ddp_rank, world_size=ddp_world_size, seed=1337)
+            if sampler_state is not None:
+                sampler.load_state_dict(sampler_state)
+                if master_process:
+                    print(f"resuming data sampler at epoch {sampler_state['epoch']}, window {sampler_state['cursor']:,}/{sampler.num_windows:,}")
+        loaders[key] = BatchLoader(path, B, T, device, prefetch=data_prefetch, seed=seed,
+                                   sort_offsets=data_sort_offsets, sampler=sampler)
+    return loaders[key].next_batch()
+
+val_sweep_cache = None
+def val_sweep_batches():
+    # every window of this rank's contiguous share of val.bin, val_batch_size windows at a time
+    global val_sweep_cache
+    windows = val_sweep_cache
+    if windows is None:
+        windows = contiguous_windows(os.path.join(data_dir, 'val.bin'), T, ddp_rank, ddp_world_size, device)
+        if val_cache:
+            val_sweep_cache = windows
+    X, Y = windows
+    for i in range(0, len(X), val_batch_size):
+        yield X[i:i+val_batch_size], Y[i:i+val_batch_size]
 
 # init these up here, can override if init_from='resume' (i.e. from a checkpoint)
 iter_num = 0
@@ -154,8 +226,10 @@ if os.path.exists(meta_path):
     print(f"found vocab_size = {meta_vocab_size} (inside {meta_path})")
 
 # model init
-model_args = dict(n_layer=n_layer, n_head=n_head, n_embd=n_embd, block_size=T,
-                  bias=bias, vocab_size=None, dropout=dropout) # start with model_args from command line
+model_args = dict(n_layer=n_layer, n_head=n_head, n_kv_head=n_kv_head, n_embd=n_embd, block_size=T,
+                  bias=bias, vocab_size=None, dropout=dropout,
+                  loss_chunk_size=loss_chunk_size, recompute=recompute,
+                  recompute_every_n=recompute_every_n) # start with model_args from command line
 if init_from == 'scratch':
     # init a new model from scratch
     print("Initializing a new model from scratch")
@@ -174,20 +248,19 @@ if init_from == 'resume':
     if master_process:
         print("loading checkpoint...")
         t0 = time.time()
-    checkpoint = torch.load(ckpt_path, map_location=device)
+    checkpoint = load_checkpoint(ckpt_path, device, broadcast=ddp and ckpt_broadcast)
     if master_process:
         t1 = time.time()
-        print(f"checkpoint loaded in {t1-t0:.2f}s")
+        load_mode = 'read by rank 0 and broadcast' if ddp and ckpt_broadcast else f'read by all {ddp_world_size} ranks'
+        print(f"checkpoint loaded in {t1-t0:.2f}s ({load_mode})")
     checkpoint_model_args = checkpoint['model_args']
     # force these config attributes to be equal otherwise we can't even resume training
     # the rest of the attributes (e.g. dropout) can stay as desired from command line
     for k in ['n_layer', 'n_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
         model_args[k] = checkpoint_model_args[k]
+    model_args['n_kv_head'] = checkpoint_model_args.get('n_kv_head', 0) # older checkpoints predate GQA
     # T must be updated from the checkpoint
     T = model_args['block_size']
-    # create the model
-    gptconf = GPTConfig(**model_args)
-    model = GPT(gptconf)
     state_dict = checkpoint['model']
     # fix the keys of the state dictionary :(
     # honestly no idea how checkpoints sometimes get this prefix, have to debug more
@@ -198,43 +271,55 @@ if init_from == 'resume':
     if master_process:
         print("loading model state...")
         t0 = time.time()
-    model.load_state_dict(state_dict)
+    # create the model
+    gptconf = GPTConfig(**model_args)
+    if meta_init:
+        model = GPT.from_state_dict(gptconf, state_dict)
+    else:
+        model = GPT(gptconf)
+        model.load_state_dict(state_dict)
     if master_process:
         t1 = time.time()
-        print(f"model loaded in {t1-t0:.2f}s")
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**20 # ru_maxrss is in KiB on linux
+        print(f"model created and loaded in {t1-t0:.2f}s (meta_init={meta_init}), peak RSS so far {peak_rss:.2f}GiB")
     iter_num = checkpoint['iter_num']
     best_val_loss = checkpoint['best_val_loss']
+    sampler_state = checkpoint.get('sampler') # older checkpoints don't have it, data order then restarts
     # wait for all processes to reach this point, ensuring checkpoint is fully written
     if ddp:
         torch.distributed.barrier()
 elif init_from.endswith('.pt'):
     print(f"Initializing from checkpoint: {init_from}")
-    checkpoint = torch.load(init_from, map_location=device)
+    checkpoint = load_checkpoint(init_from, device, broadcast=ddp and ckpt_broadcast)
     checkpoint_model_args = checkpoint['model_args']
     # force these config attributes to be equal otherwise we can't even resume training
     # the rest of the attributes (e.g. dropout) can stay as desired from command line
     for k in ['n_layer', 'n_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
         model_args[k] = checkpoint_model_args[k]
+    model_args['n_kv_head'] = checkpoint_model_args.get('n_kv_head', 0) # older checkpoints predate GQA
     # T must be updated from the checkpoint
     T = model_args['block_size']
-    # create the model
-    gptconf = GPTConfig(**model_args)
-    model = GPT(gptconf)
     state_dict = checkpoint['model']
     # fix the keys of the state dictionary :(
     unwanted_prefix = '_orig_mod.'
     for k,v in list(state_dict.items()):
         if k.startswith(unwanted_prefix):
             state_dict[k[len(unwanted_prefix):]] = state_dict.pop(k)
-    model.load_state_dict(state_dict)
+    # create the model
+    gptconf = GPTConfig(**model_args)
+    if meta_init:
+        model = GPT.from_state_dict(gptconf, state_dict)
+    else:
+        model = GPT(gptconf)
+        model.load_state_dict(state_dict)
     checkpoint = None # free up memory
 elif init_from.startswith('gpt2'):
     print(f"Initializing from OpenAI GPT-2 weights: {init_from}")
     # initialize from OpenAI GPT-2 weights
     override_args = dict(dropout=dropout)
-    model = GPT.from_pretrained(init_from, override_args)
+    model = GPT.from_pretrained(init_from, override_args, weights_path=pretrained_weights or None)
     # read off the created config params, so we can store them into checkpoint correctly
-    for k in ['n_layer', 'n_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
+    for k in ['n_layer', 'n_head', 'n_kv_head', 'n_embd', 'block_size', 'bias', 'vocab_size']:
         model_args[k] = getattr(model.config, k)
 # crop down the model block size if desired, using model surgery
 if T < model.config.block_size:
@@ -246,9 +331,28 @@ model.to(device)
 scaler = torch.amp.GradScaler('cuda', enabled=(dtype == 'float16'))
 
 # optimizer
-optimizer = model.configure_optimizers(weight_decay, learning_rate, (beta1, beta2), device_type)
+zero = ddp and zero_optimizer
+optimizer = model.configure_optimizers(weight_decay, learning_rate, (beta1, beta2), device_type, zero=zero)
+if zero:
+    # the AdamW state (exp_avg, exp_avg_sq) is as large as two copies of the parameters, now each rank holds only its share
+    state_size = lambda params: sum(2 * p.numel() * p.element_size() for p in params)
+    full_state = state_size(model.parameters())
+    local_state = state_size(p for g in optimizer.optim.param_groups for p in g['params'])
+    print(f"rank {ddp_rank}: optimizer state {local_state/2**20:.1f}MiB instead of {full_state/2**20:.1f}MiB, "
+          f"{(full_state - local_state)/2**20:.1f}MiB saved")
 if init_from == 'resume':
-    optimizer.load_state_dict(checkpoint['optimizer'])
+    optimizer_shards = checkpoint.get('optimizer_shards', 0)
+    if optimizer_shards:
+        # sharded checkpoint: every rank reads back the optimizer state of its own partition
+        assert zero and optimizer_shards == ddp_world_size, \
+            f"the optimizer state was saved in {optimizer_shards} shards, resume with zero_optimizer=True on as many ranks"
+        shard = torch.load(os.path.join(out_dir, f'ckpt_optim{ddp_rank}.pt'), map_location=device)
+        optimizer.optim.load_state_dict(shard['optimizer'])
+        for group, local_group in zip(optimizer.param_groups, optimizer.optim.param_groups):
+            group['lr'] = local_group['lr'] # for the resumed lr schedule below
+        shard = None
+    else:
+        optimizer.load_state_dict(checkpoint['optimizer']) # with ZeRO every rank keeps its partition of the full state
 checkpoint = None # free up memory
 
 # compile the model
@@ -259,23 +363,38 @@ if compile:
 
 # wrap model into DDP container
 if ddp:
-    model = DDP(model, device_ids=[ddp_local_rank])
+    model = DDP(model, device_ids=[ddp_local_rank] if device_type == 'cuda' else None)
+    comm_counter = register_comm_hook(model, ddp_comm_hook, powersgd_rank, powersgd_start_iter)
 
 # helps estimate an arbitrarily accurate loss over either split using many batches
+# every rank evaluates its share of the batches, the losses are summed up on the device and
+# combined with a single all_reduce, so there is one host sync per eval instead of one per batch
 @torch.no_grad()
 def estimate_loss():
-    out = {}
-    model.eval()
-    for split in ['train', 'val']:
-        losses = torch.zeros(eval_iters)
-        for k in range(eval_iters):
-            X, Y, _ = get_batch(split)
-            with ctx:
-                logits, loss = model(X, Y)
-            losses[k] = loss.item()
-        out[split] = losses.mean()
-    model.train()
-    return out
+    splits = ['train', 'val']
+    # without the DDP wrapper, whose forward may communicate: in a val sweep the ranks can run different numbers of batches
+    eval_model = model.module if ddp else model
+    eval_model.eval()
+    iters = math.ceil(eval_iters / ddp_world_size)
+    loss_sums = torch.zeros(len(splits), 2, device=device) # per split: summed loss and its weight
+    for i, split in enumerate(splits):
+        if split == 'val' and val_mode == 'sweep':
+            for X, Y in val_sweep_batches():
+                with ctx:
+                    logits, loss = eval_model(X, Y)
+                loss_sums[i, 0] += loss.float() * Y.numel() # weighted by tokens, the last batch may be smaller
+                loss_sums[i, 1] += Y.numel()
+        else:
+            for k in range(iters):
+                X, Y, _ = get_batch(split, for_eval=True)
+                with ctx:
+                    logits, loss = eval_model(X, Y)
+                loss_sums[i, 0] += loss.float()
+                loss_sums[i, 1] += 1
+    if ddp:
+        torch.distributed.all_reduce(loss_sums) # works with nccl and gloo alike
+    eval_model.train()
+    return dict(zip(splits, (loss_sums[:, 0] / loss_sums[:, 1]).tolist()))
 
 # learning rate decay scheduler (cosine with warmup)
 def get_lr(it):
@@ -320,6 +439,17 @@ raw_model = model.module if ddp else model # unwrap DDP container if needed
 running_mfu = -1.0
 debugger = Debug(master_process, debug_batches)
 trigger_iters = {9, 10, 19, 20, 29, 30, 59, 60, 99, 100, 119, 120}
+timer = StepTimer(time_phases, cuda=(device_type == 'cuda'), window=time_phases_window,
+                  path=os.path.join(out_dir, 'step_times.jsonl') if master_process else None)
+loss_logger = LossLog(os.path.join(out_dir, 'loss.jsonl') if loss_log else None, loss_reference) if master_process else None
+if time_phases and ddp and gradient_accumulation_steps == 1 and master_process:
+    print("time_phases: every backward all-reduces with gradient_accumulation_steps=1, so the exposed all-reduce time can't be separated from backward_sync")
+checkpointer = AsyncCheckpointer(out_dir, keep_iters=snapshot_iters, keep_last=keep_last_snapshots,
+                                 async_write=async_checkpoint)
+if zero:
+    # every rank writes its shard of the optimizer state next to the checkpoint, e.g. ckpt_optim3.pt
+    optimizer_checkpointer = AsyncCheckpointer(out_dir, keep_iters=snapshot_iters, keep_last=keep_last_snapshots,
+                                               async_write=async_checkpoint, suffix=f'_optim{ddp_rank}')
 
 while True:
 
@@ -330,10 +460,15 @@ while True:
         param_group['lr'] = lr
 
     # evaluate the loss on train/val sets and write checkpoints
-    if iter_num % eval_interval == 0 and master_process:
-        losses = estimate_loss()
-        print(f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}")
-        if wandb_log:
+    if iter_num % eval_interval == 0 and eval_inline:
+        losses = estimate_loss() # all ranks take part, and all get the same (all-reduced) losses
+        if master_process:
+            loss_logger.log(iter_num, val_loss=losses['val'])
+            print_str = f"step {iter_num}: train loss {losses['train']:.4f}, val loss {losses['val']:.4f}"
+            if loss_logger.gap('val_loss') is not None:
+                print_str += f", val loss vs reference {loss_logger.gap('val_loss')*100:+.2f}%"
+            print(print_str)
+        if wandb_log and master_process:
             metrics = {
                 "iter": iter_num,
                 "train/loss": losses['train'],
@@ -344,30 +479,33 @@ while True:
                 metrics['mfu'] = running_mfu * 100
                 metrics['tokens/sec'] = tokens_per_iter/dt
             wandb.log(metrics)
-        if losses['val'] < best_val_loss or always_save_checkpoint:
-            best_val_loss = losses['val']
+    if iter_num % eval_interval == 0:
+        # decided on every rank alike, with a sharded optimizer they all write part of the checkpoint
+        ckpt_files = []
+        if not eval_inline or losses['val'] < best_val_loss or always_save_checkpoint:
+            if eval_inline:
+                best_val_loss = losses['val']
             if iter_num > 0 and local_iter_num > 0:
-                checkpoint = {
-                    'model': raw_model.state_dict(),
-                    'optimizer': optimizer.state_dict(),
-                    'model_args': model_args,
-                    'iter_num': iter_num,
-                    'best_val_loss': best_val_loss,
-                    'config': config,
-                }
-                print(f"saving checkpoint to {out_dir}")
-                torch.save(checkpoint, os.path.join(out_dir, 'ckpt.pt'))
-        if iter_num in [10, 250, 1000]:
+                ckpt_files.append('ckpt.pt')
+        if iter_num in snapshot_iters or (snapshot_interval > 0 and iter_num > 0 and iter_num % snapshot_interval == 0):
+            ckpt_files.append(f'ckpt_{iter_num}.pt')
+        if ckpt_files and zero:
+            optimizer_checkpointer.save({'optimizer': optimizer.optim.state_dict(), 'rank': ddp_rank}, ckpt_files)
+        if ckpt_files and master_process:
             checkpoint = {
                 'model': raw_model.state_dict(),
-                'optimizer': optimizer.state_dict(),
+                'optimizer': None if zero else optimizer.state_dict(),
+                'optimizer_shards': ddp_world_size if zero else 0,
                 'model_args': model_args,
                 'iter_num': iter_num,
                 'best_val_loss': best_val_loss,
                 'config': config,
+                'sampler': loaders['train'].state_dict(),
             }
-            print(f"saving checkpoint to {out_dir} at iter {iter_num}")
-            torch.save(checkpoint, os.path.join(out_dir, f'ckpt_{iter_num}.pt'))
+            print(f"saving {', '.join(ckpt_files)} to {out_dir}")
+            blocked = checkpointer.save(checkpoint, ckpt_files)
+            print(f"training blocked for {blocked*1000:.2f}ms by the checkpoint")
+            checkpoint = None
     if iter_num == 0 and eval_only:
         break
 
@@ -381,39 +519,58 @@ while True:
             # I really dislike that this bloats the code and forces us to repeat code
             # looking at the source of that context manager, it just toggles this variable
             model.require_backward_grad_sync = (micro_step == gradient_accumulation_steps - 1)
-        with ctx:
+        with timer.phase('forward'), ctx:
             logits, loss = model(X, Y)
             loss = loss / gradient_accumulation_steps # scale the loss to account for gradient accumulation
         # immediately async prefetch next batch while model is doing the forward pass on the GPU
-        X, Y, ix = get_batch('train')
+        with timer.phase('data', host=True):
+            X, Y, ix = get_batch('train')
         # backward pass, with gradient scaling if training in fp16
-        scaler.scale(loss).backward()
+        # (under DDP the backward of the last micro step also all-reduces the gradients)
+        with timer.phase('backward_sync' if ddp and micro_step == gradient_accumulation_steps - 1 else 'backward'):
+            scaler.scale(loss).backward()
     # clip the gradient
     grad_norm = None
     if grad_clip != 0.0:
-        scaler.unscale_(optimizer)
-        grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
+        with timer.phase('clip'):
+            scaler.unscale_(optimizer)
+            grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
     # step the optimizer and scaler if training in fp16
-    scaler.step(optimizer)
-    scaler.update()
-    # flush the gradients as soon as we can, no need for this memory anymore
-    optimizer.zero_grad(set_to_none=True)
+    with timer.phase('optimizer'):
+        scaler.step(optimizer)
+        scaler.update()
+        # flush the gradients as soon as we can, no need for this memory anymore
+        optimizer.zero_grad(set_to_none=True)
+    timer.step(iter_num)
 
     # timing and logging
     t1 = time.time()
     dt = t1 - t0
     t0 = t1
+    data_wait = loaders['train'].pop_wait_time() # time this iteration spent blocked on get_batch('train')
+    comm_bytes = comm_counter.pop() if ddp else 0 # gradient all-reduce payload of this iteration
     if iter_num % log_interval == 0 and master_process:
         # get loss as float. note: this is a CPU-GPU sync point
         # scale up to undo the division above, approximating the true total loss (exact would have been a sum)
         lossf = loss.item() * gradient_accumulation_steps
+        loss_logger.log(iter_num, loss=lossf)
         if local_iter_num >= 5: # let the training loop settle a bit
             mfu = raw_model.estimate_mfu(B * gradient_accumulation_steps, dt)
             running_mfu = mfu if running_mfu == -1.0 else 0.9*running_mfu + 0.1*mfu
         tokens_per_sec = tokens_per_iter / dt
-        print_str = f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, mfu {running_mfu*100:.2f}%, tok/sec {tokens_per_sec:.2f}"
+        print_str = f"iter {iter_num}: loss {lossf:.4f}, time {dt*1000:.2f}ms, data wait {data_wait*1000:.2f}ms, mfu {running_mfu*100:.2f}%, tok/sec {tokens_per_sec:.2f}"
         if grad_norm is not None:
             print_str += f", grad_norm {grad_norm:.4f}"
+        if ddp:
+            print_str += f", all-reduce {comm_bytes/2**20:.2f}MiB ({ddp_comm_hook})"
+        if loss_logger.gap('loss') is not None:
+            # mean over the last few logged iterations, single steps are too noisy to compare
+            print_str += f", loss vs reference {loss_logger.gap('loss')*100:+.2f}%"
+        if time_phases:
+            print_str += f", p50/p95 {timer.format_summary()}"
+        if scaling_baseline > 0:
+            # throughput of all ranks together vs world_size perfectly scaled single-process runs
+            print_str += f", scaling efficiency {tokens_per_sec / (ddp_world_size * scaling_baseline) * 100:.1f}%"
         print(print_str)
         if wandb_log and local_iter_num >= 5:
             log_dict = {
@@ -421,10 +578,14 @@ while True:
                 "train/loss": lossf,
                 "mfu": running_mfu * 100,
                 "tokens/sec": tokens_per_iter / dt,
+                "data_wait_ms": data_wait * 1000,
+                "comm_mib": comm_bytes / 2**20,
                 "lr": lr,
             }
             if grad_norm is not None:
                 log_dict['train/grad_norm'] = grad_norm.item()
+            if loss_logger.gap('loss') is not None:
+                log_dict['train/loss_gap'] = loss_logger.gap('loss')
             wandb.log(log_dict, step=iter_num)
     iter_num += 1
     local_iter_num += 1
@@ -433,6 +594,12 @@ while True:
     if iter_num > max_iters:
         break
 
+checkpointer.wait() # let the last checkpoint finish writing
+timer.close()
+if master_process:
+    loss_logger.close()
+if zero:
+    optimizer_checkpointer.wait()
 if ddp:
     destroy_process_group()
 
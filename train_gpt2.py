@@ -6,7 +6,7 @@ from dataclasses import dataclass
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
-from hellaswag import render_example, iterate_examples
+import hellaswag
 # -----------------------------------------------------------------------------
 
 class CausalSelfAttention(nn.Module):
@@ -202,14 +202,17 @@ class GPT(nn.Module):
         return optimizer
 
 # -----------------------------------------------------------------------------
+import threading
 import tiktoken
 import numpy as np
 
 def load_tokens(filename):
-    npt = np.load(filename)
-    npt = npt.astype(np.int32) # added after video
-    ptt = torch.tensor(npt, dtype=torch.long)
-    return ptt
+    # memory-mapped: the shard stays uint16 on disk / in the page cache, next_batch widens one window at a time
+    return np.load(filename, mmap_mode='r')
+
+def page_in(tokens):
+    # read one token per 4KiB page, to pull the whole shard into the page cache
+    tokens[::2048].max()
 
 class DataLoaderLite:
     def __init__(self, B, T, process_rank, num_processes, split):
@@ -229,50 +232,59 @@ class DataLoaderLite:
         assert len(shards) > 0, f"no shards found for split {split}"
         if master_process:
             print(f"found {len(shards)} shards for split {split}")
+        self.current_shard = None
+        self.prefetch_thread = None
+        self.prefetched = None # (shard index, tokens) of the next shard, opened and paged in by prefetch_thread
         self.reset()
 
+    def load_shard(self, shard):
+        if self.prefetch_thread is not None:
+            self.prefetch_thread.join()
+            self.prefetch_thread = None
+        if self.prefetched is not None and self.prefetched[0] == shard:
+            self.tokens = self.prefetched[1]
+        else:
+            self.tokens = load_tokens(self.shards[shard])
+        self.prefetched = None
+        self.current_shard = shard
+        if len(self.shards) > 1:
+            # open and page in the following shard in the background, well before we reach the boundary
+            next_shard = (shard + 1) % len(self.shards)
+            def prefetch():
+                tokens = load_tokens(self.shards[next_shard])
+                page_in(tokens)
+                self.prefetched = (next_shard, tokens)
+            self.prefetch_thread = threading.Thread(target=prefetch, daemon=True)
+            self.prefetch_thread.start()
+
     def reset(self):
         # state, init at shard zero
-        self.current_shard = 0
-        self.tokens = load_tokens(self.shards[self.current_shard])
+        if self.current_shard != 0:
+            self.load_shard(0)
         self.current_position = self.B * self.T * self.process_rank
 
     def next_batch(self):
         B, T = self.B, self.T
-        buf = self.tokens[self.current_position : self.current_position+B*T+1]
+        # only this window of the shard gets widened to int64
+        buf = torch.from_numpy(self.tokens[self.current_position : self.current_position+B*T+1].astype(np.int64))
         x = (buf[:-1]).view(B, T) # inputs
         y = (buf[1:]).view(B, T) # targets
         # advance the position in the tensor
         self.current_position += B * T * self.num_processes
         # if loading the next batch would be out of bounds, advance to next shard
         if self.current_position + (B * T * self.num_processes + 1) > len(self.tokens):
-            self.current_shard = (self.current_shard + 1) % len(self.shards)
-            self.tokens = load_tokens(self.shards[self.current_shard])
+            self.load_shard((self.current_shard + 1) % len(self.shards))
             self.current_position = B * T * self.process_rank
         return x, y
 
-# -----------------------------------------------------------------------------
-# helper function for HellaSwag eval
-# takes tokens, mask, and logits, returns the index of the completion with the lowest loss
-
-def get_most_likely_row(tokens, mask, logits):
-    # evaluate the autoregressive loss at all positions
-    shift_logits = (logits[..., :-1, :]).contiguous()
-    shift_tokens = (tokens[..., 1:]).contiguous()
-    flat_shift_logits = shift_logits.view(-1, shift_logits.size(-1))
-    flat_shift_tokens = shift_tokens.view(-1)
-    shift_losses = F.cross_entropy(flat_shift_logits, flat_shift_tokens, reduction='none')
-    shift_losses = shift_losses.view(tokens.size(0), -1)
-    # now get the average loss just for the completion region (where mask == 1), in each row
-    shift_mask = (mask[..., 1:]).contiguous() # we must shift mask, so we start at the last prompt token
-    masked_shift_losses = shift_losses * shift_mask
-    # sum and divide by the number of 1s in the mask
-    sum_loss = masked_shift_losses.sum(dim=1)
-    avg_loss = sum_loss / shift_mask.sum(dim=1)
-    # now we have a loss for each of the 4 completions
-    # the one with the lowest loss should be the most likely
-    pred_norm = avg_loss.argmin().item()
-    return pred_norm
+    def state_dict(self):
+        # the position of the next batch, without this rank's offset so that it is the same on every rank
+        return {'shard': self.current_shard, 'position': self.current_position - self.B * self.T * self.process_rank}
+
+    def load_state_dict(self, state):
+        if state['shard'] != self.current_shard:
+            self.load_shard(state['shard'])
+        self.current_position = state['position'] + self.B * self.T * self.process_rank
 
 # -----------------------------------------------------------------------------
 # simple launch:
@@ -340,6 +352,7 @@ model = GPT(GPTConfig(vocab_size=50304))
 # model = GPT.from_pretrained("gpt2") # or init from OpenAI GPT-2
 model.to(device)
 use_compile = False # torch.compile interferes with HellaSwag eval and Generation. TODO fix
+inline_eval = True # False: only write a checkpoint every 250 steps, and run evaluator.py --watch_dir=log alongside
 if use_compile:
     model = torch.compile(model)
 if ddp:
@@ -373,12 +386,20 @@ log_file = os.path.join(log_dir, f"log.txt")
 with open(log_file, "w") as f: # open for writing to clear the file
     pass
 
+# HellaSwag val, tokenized once: this rank's share of the examples, scored in large batches at every eval
+hellaswag_examples = None
+hellaswag_found = os.path.exists(os.path.join(hellaswag.DATA_DIR, "hellaswag_val.jsonl"))
+if inline_eval and hellaswag_found:
+    hellaswag_examples = hellaswag.render_examples(hellaswag.iterate_examples("val"), ddp_rank, ddp_world_size)
+elif inline_eval and master_process:
+    print(f"no hellaswag_val.jsonl in {hellaswag.DATA_DIR}, skipping the HellaSwag eval")
+
 for step in range(max_steps):
     t0 = time.time()
     last_step = (step == max_steps - 1)
 
     # once in a while evaluate our validation loss
-    if step % 250 == 0 or last_step:
+    if (step % 250 == 0 or last_step) and inline_eval:
         model.eval()
         val_loader.reset()
         with torch.no_grad():
@@ -397,54 +418,35 @@ for step in range(max_steps):
             print(f"validation loss: {val_loss_accum.item():.4f}")
             with open(log_file, "a") as f:
                 f.write(f"{step} val {val_loss_accum.item():.4f}\n")
-            if step > 0 and (step % 5000 == 0 or last_step):
-                # optionally write model checkpoints
-                checkpoint_path = os.path.join(log_dir, f"model_{step:05d}.pt")
-                checkpoint = {
-                    'model': raw_model.state_dict(),
-                    'config': raw_model.config,
-                    'step': step,
-                    'val_loss': val_loss_accum.item()
-                }
-                # you might also want to add optimizer.state_dict() and
-                # rng seeds etc., if you wanted to more exactly resume training
-                torch.save(checkpoint, checkpoint_path)
+
+    # optionally write model checkpoints
+    checkpoint_interval = 5000 if inline_eval else 250
+    if master_process and step > 0 and (step % checkpoint_interval == 0 or last_step):
+        checkpoint_path = os.path.join(log_dir, f"model_{step:05d}.pt")
+        checkpoint = {
+            'model': raw_model.state_dict(),
+            'config': raw_model.config,
+            'step': step,
+            'val_loss': val_loss_accum.item() if inline_eval else None,
+            'train_loader': train_loader.state_dict(), # to resume mid-epoch: train_loader.load_state_dict(...)
+        }
+        # you might also want to add optimizer.state_dict() and
+        # rng seeds etc., if you wanted to more exactly resume training
+        torch.save(checkpoint, checkpoint_path)
 
     # once in a while evaluate hellaswag
-    if (step % 250 == 0 or last_step) and (not use_compile):
-        num_correct_norm = 0
-        num_total = 0
-        for i, example in enumerate(iterate_examples("val")):
-            # only process examples where i % ddp_world_size == ddp_rank
-            if i % ddp_world_size != ddp_rank:
-                continue
-            # render the example into tokens and labels
-            _, tokens, mask, label = render_example(example)
-            tokens = tokens.to(device)
-            mask = mask.to(device)
-            # get the logits
-            with torch.no_grad():
-                with torch.autocast(device_type=device_type, dtype=torch.bfloat16):
-                    logits, loss = model(tokens)
-                pred_norm = get_most_likely_row(tokens, mask, logits)
-            num_total += 1
-            num_correct_norm += int(pred_norm == label)
-        # reduce the stats across all processes
-        if ddp:
-            num_total = torch.tensor(num_total, dtype=torch.long, device=device)
-            num_correct_norm = torch.tensor(num_correct_norm, dtype=torch.long, device=device)
-            dist.all_reduce(num_total, op=dist.ReduceOp.SUM)
-            dist.all_reduce(num_correct_norm, op=dist.ReduceOp.SUM)
-            num_total = num_total.item()
-            num_correct_norm = num_correct_norm.item()
-        acc_norm = num_correct_norm / num_total
+    if (step % 250 == 0 or last_step) and (not use_compile) and inline_eval and hellaswag_examples is not None:
+        model.eval()
+        acc, acc_norm, num_total = hellaswag.evaluate(
+            lambda tokens: raw_model(tokens)[0], hellaswag_examples, device, batch_size=16,
+            world_size=ddp_world_size, ctx=torch.autocast(device_type=device_type, dtype=torch.bfloat16))
         if master_process:
-            print(f"HellaSwag accuracy: {num_correct_norm}/{num_total}={acc_norm:.4f}")
+            print(f"HellaSwag accuracy: {round(acc_norm * num_total)}/{num_total}={acc_norm:.4f}")
             with open(log_file, "a") as f:
                 f.write(f"{step} hella {acc_norm:.4f}\n")
 
     # once in a while generate from the model (except step 0, which is noise)
-    if ((step > 0 and step % 250 == 0) or last_step) and (not use_compile):
+    if ((step > 0 and step % 250 == 0) or last_step) and (not use_compile) and inline_eval:
         model.eval()
         num_return_sequences = 4
         max_length = 32